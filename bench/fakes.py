@@ -0,0 +1,176 @@
+import asyncio
+import itertools
+import random
+import re
+from datetime import datetime, timedelta, timezone
+
+from pyrogram import enums
+from pyrogram.errors import FloodWait
+
+MEDIA_KINDS = ("photo", "voice", "video", "document", "sticker")
+
+
+class Obj:
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def fake_message(message_id: int, date: datetime, rng: random.Random, media_ratio: float, bot_ratio: float):
+    media = {kind: None for kind in ("audio", "voice", "video", "photo", "document", "sticker", "animation",
+                                     "video_note")}
+    text = " ".join(rng.choice(("hello", "meeting", "tomorrow", "deploy", "lunch", "bug", "release", "ok"))
+                    for _ in range(rng.randint(3, 40)))
+    caption = None
+    if rng.random() < media_ratio:
+        kind = rng.choice(MEDIA_KINDS)
+        media[kind] = Obj(file_name=f"file{message_id}.pdf", file_unique_id=f"u{message_id}", file_size=50000)
+        caption, text = (text if rng.random() < 0.5 else None), None
+    user = Obj(first_name=f"User{rng.randint(1, 30)}", is_bot=rng.random() < bot_ratio)
+    return Obj(id=message_id, date=date, from_user=user, text=text, caption=caption, empty=False, service=None,
+               forward_from=None, forward_sender_name=None, forward_from_chat=None, forward_from_message_id=None,
+               forward_date=None, **media)
+
+
+class FakeUserClient:
+    def __init__(self, messages_per_hour: float = 60, media_ratio: float = 0.2, bot_ratio: float = 0.05,
+                 flood_probability: float = 0.0, flood_seconds: int = 1, page_latency: float = 0.05,
+                 connect_latency: float = 0.5, seed: int = 0):
+        self.messages_per_hour = messages_per_hour
+        self.media_ratio = media_ratio
+        self.bot_ratio = bot_ratio
+        self.flood_probability = flood_probability
+        self.flood_seconds = flood_seconds
+        self.page_latency = page_latency
+        self.connect_latency = connect_latency
+        self.rng = random.Random(seed)
+        self.is_initialized = False
+        self.is_connected = False
+        self.history = {}
+        self.handlers = []
+        self.api_calls = 0
+
+    async def start(self):
+        await asyncio.sleep(self.connect_latency)
+        self.is_initialized = self.is_connected = True
+
+    async def stop(self):
+        # like pyrogram, stopping the dispatcher forgets every registered handler
+        self.is_initialized = self.is_connected = False
+        self.handlers = []
+
+    async def connect(self):
+        self.is_connected = True
+
+    async def get_me(self):
+        return Obj(id=0)
+
+    def maybe_flood(self):
+        self.api_calls += 1
+        if self.rng.random() < self.flood_probability:
+            raise FloodWait(value=self.flood_seconds)
+
+    def chat_history(self, chat_id: int) -> list:
+        history = self.history.get(chat_id)
+        if history is None:
+            now = datetime.now(timezone.utc)
+            count = int(self.messages_per_hour * 48)
+            step = timedelta(hours=48) / max(count, 1)
+            history = [fake_message(count - i, now - step * i, self.rng, self.media_ratio, self.bot_ratio)
+                       for i in range(count)]
+            self.history[chat_id] = history
+        return history
+
+    def add_handler(self, handler, group: int = 0):
+        self.handlers.append(handler)
+
+    def remove_handler(self, handler, group: int = 0):
+        self.handlers.remove(handler)
+
+    async def push(self, chat_id: int):
+        # deliver a new message to the history and to update handlers, like a live update
+        history = self.chat_history(chat_id)
+        message = fake_message(history[0].id + 1, datetime.now(timezone.utc), self.rng, self.media_ratio,
+                               self.bot_ratio)
+        history.insert(0, message)
+        for handler in self.handlers:
+            # pyromod wraps callbacks with conversation listeners that the fake client doesn't have
+            callback = getattr(handler, "original_callback", handler.callback)
+            await callback(self, Obj(chat=Obj(id=chat_id), **message.__dict__))
+
+    async def get_chat(self, chat_id):
+        self.maybe_flood()
+        await asyncio.sleep(self.page_latency)
+        return Obj(id=int(chat_id), title=f"Chat {chat_id}", type=enums.ChatType.SUPERGROUP)
+
+    async def get_chat_history(self, chat_id, limit: int = 0, offset_id: int = 0):
+        history = self.chat_history(int(chat_id))
+        for index, message in enumerate(itertools.islice(history, limit or None)):
+            if index % 100 == 0:
+                self.maybe_flood()
+                await asyncio.sleep(self.page_latency)
+            yield Obj(**message.__dict__)
+
+    async def get_dialogs(self):
+        for chat_id in list(self.history) or range(1, 41):
+            await asyncio.sleep(self.page_latency / 100)
+            yield Obj(chat=Obj(id=chat_id, title=f"Chat {chat_id}", type=enums.ChatType.SUPERGROUP,
+                               first_name=None, last_name=None), top_message=None)
+
+
+class FakeLLM:
+    def __init__(self, latency: float = 1.0, tokens_per_second: float = 50, summary_tokens: int = 150):
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.summary_tokens = summary_tokens
+        self.requests = 0
+        self.prompt_chars = 0
+
+    def summary(self, chat_messages: list) -> str:
+        self.requests += 1
+        self.prompt_chars += sum(len(i["content"]) for i in chat_messages)
+        text = " ".join(["summary"] * self.summary_tokens)
+        # answer digest prompts with one section per chat, like the real model is asked to
+        sections = re.findall(r"^### (\d+)", chat_messages[1]["content"], re.MULTILINE)
+        if sections:
+            return "\n".join(f"### {i}\n{text}" for i in sections)
+        return text
+
+    async def complete(self, chat_messages: list, model: str) -> str:
+        text = self.summary(chat_messages)
+        await asyncio.sleep(self.latency + self.summary_tokens / self.tokens_per_second)
+        return text
+
+    async def stream(self, chat_messages: list, model: str):
+        self.summary(chat_messages)
+        await asyncio.sleep(self.latency)
+        for _ in range(self.summary_tokens):
+            await asyncio.sleep(1 / self.tokens_per_second)
+            yield "summary "
+
+    async def warm_up(self):
+        pass
+
+    async def close(self):
+        pass
+
+
+class FakeBotApp:
+    def __init__(self, latency: float = 0.02, hours: int = 24):
+        self.latency = latency
+        self.hours = hours
+        self.ids = itertools.count(1)
+        self.sent = 0
+        self.edited = 0
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await asyncio.sleep(self.latency)
+        self.sent += 1
+        return Obj(id=next(self.ids), chat=Obj(id=chat_id), text=text)
+
+    async def edit_message_text(self, chat_id, message_id, text, **kwargs):
+        await asyncio.sleep(self.latency)
+        self.edited += 1
+        return Obj(id=message_id, chat=Obj(id=chat_id), text=text)
+
+    async def ask(self, chat_id, text, **kwargs):
+        return Obj(text=str(self.hours))
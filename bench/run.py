@@ -0,0 +1,132 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import src.bot_manager as bot_manager
+from bench.fakes import FakeBotApp, FakeLLM, FakeUserClient
+from src.bot_manager import BotManager
+from src.registry import UserRecord
+
+
+def percentile(samples: list, pct: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def timed(samples: list, function):
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await function(*args, **kwargs)
+        finally:
+            samples.append(time.perf_counter() - started)
+    return wrapper
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Load test BotManager against fake Telegram and OpenAI backends")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--chats", type=int, default=5, help="tracked chats per user")
+    parser.add_argument("--hours", type=int, default=24)
+    parser.add_argument("--rounds", type=int, default=2, help="/now calls per user")
+    parser.add_argument("--messages-per-hour", type=float, default=60)
+    parser.add_argument("--media-ratio", type=float, default=0.2)
+    parser.add_argument("--flood-probability", type=float, default=0.0)
+    parser.add_argument("--page-latency", type=float, default=0.05)
+    parser.add_argument("--connect-latency", type=float, default=0.5)
+    parser.add_argument("--llm-latency", type=float, default=1.0)
+    parser.add_argument("--llm-tokens-per-second", type=float, default=50)
+    parser.add_argument("--workers", type=int, default=5)
+    parser.add_argument("--no-stream", action="store_true")
+    parser.add_argument("--realtime", action="store_true", help="buffer chats from live updates")
+    parser.add_argument("--json", help="write the report to this file")
+    return parser.parse_args()
+
+
+async def run(args) -> dict:
+    workdir = tempfile.mkdtemp(prefix="summary-bench-")
+    app = FakeBotApp(hours=args.hours)
+    manager = BotManager(app=app, api_id=0, api_hash="", openai_api="bench", phrase="Summarise", model="gpt-4o-mini",
+                         json_file=os.path.join(workdir, "users.json"),
+                         message_cache_file=os.path.join(workdir, "messages.db"), queue_workers=args.workers,
+                         stream=not args.no_stream, stream_edit_interval=0.5, telegram_rate=1000, bot_rate=1000,
+                         bot_chat_rate=1000, live_buffer_file=os.path.join(workdir, "live.json") if args.realtime else None,
+                         max_sessions=args.users + 1)
+    llm = manager.llm = FakeLLM(args.llm_latency, args.llm_tokens_per_second)
+    clients = []
+
+    def create_client(phone):
+        client = FakeUserClient(args.messages_per_hour, args.media_ratio, flood_probability=args.flood_probability,
+                                page_latency=args.page_latency, connect_latency=args.connect_latency,
+                                seed=len(clients))
+        clients.append(client)
+        return client
+
+    manager.session_pool.create_client = create_client
+    await manager.start()
+    for user_id in range(1, args.users + 1):
+        manager.registry.add(UserRecord(user_id, 0, phone=f"+{user_id}",
+                                        chats=[user_id * 1000 + i for i in range(args.chats)]))
+    if manager.live is not None:
+        # catching up happens in the background at startup, finish it before measuring
+        await asyncio.gather(*[manager.subscribe_live(i) for i in range(1, args.users + 1)])
+
+    stages = {"parse_messages": [], "summarise": [], "chat": [], "now": []}
+    bot_manager.parse_messages = timed(stages["parse_messages"], bot_manager.parse_messages)
+    bot_manager.summarise = timed(stages["summarise"], bot_manager.summarise)
+    manager.summarise_chat = timed(stages["chat"], manager.summarise_chat)
+
+    async def user_rounds(user_id):
+        for _ in range(args.rounds):
+            await timed(stages["now"], manager.messages_now)(user_id)
+
+    tracemalloc.start()
+    started = time.perf_counter()
+    await asyncio.gather(*[user_rounds(i) for i in range(1, args.users + 1)])
+    elapsed = time.perf_counter() - started
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    await manager.shutdown()
+
+    chats = len(stages["chat"])
+    return {
+        "elapsed_seconds": round(elapsed, 3),
+        "chat_summaries": chats,
+        "throughput_chats_per_second": round(chats / elapsed, 3) if elapsed else 0,
+        "peak_memory_mb": round(peak_memory / 2 ** 20, 2),
+        "llm_requests": llm.requests,
+        "llm_prompt_chars": llm.prompt_chars,
+        "telegram_api_calls": sum(i.api_calls for i in clients),
+        "bot_messages_sent": app.sent,
+        "bot_messages_edited": app.edited,
+        "latency": {name: {"p50": round(percentile(samples, 50), 3), "p95": round(percentile(samples, 95), 3),
+                           "p99": round(percentile(samples, 99), 3), "count": len(samples)}
+                    for name, samples in stages.items()},
+    }
+
+
+def main():
+    args = parse_args()
+    for name in list(logging.root.manager.loggerDict):
+        if name.startswith("src"):
+            logging.getLogger(name).setLevel(logging.WARNING)
+    report = asyncio.run(run(args))
+    print(json.dumps(report, indent=2))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,22 @@
 # main.py
+import time
+
+STARTED = time.perf_counter()
+
+import argparse
+import cProfile
 import logging
+import os
 import signal
 import sys
 import asyncio
 from pyromod import Client as BotClient
-from pyrogram import idle
 
 from src.config import load_config
 from src.bot_manager import BotManager
 from src.handlers import register_handlers
+from src.metrics import STARTUP_SECONDS
+from src.sharding import Coordinator, RemoteBot, Worker
 
 
 logging.basicConfig(level=logging.INFO)
@@ -19,22 +27,87 @@ logger.setLevel(logging.DEBUG)
 manager = None
 app = None
 
-async def custom_run(app: BotClient, manager: BotManager):
+class StartupProfile:
+    def __init__(self, enabled: bool, filename: str):
+        self.enabled = enabled
+        self.filename = filename
+        self.phases = []
+        self.profiler = cProfile.Profile() if enabled else None
+        if enabled:
+            self.profiler.enable()
+
+    def mark(self, phase: str):
+        elapsed = time.perf_counter() - STARTED
+        STARTUP_SECONDS.set(elapsed, phase=phase)
+        self.phases.append((phase, elapsed))
+
+    async def finish(self, manager: BotManager):
+        if manager.warm_task is not None:
+            await asyncio.gather(manager.warm_task, return_exceptions=True)
+            self.mark("warm")
+        if not self.enabled:
+            return
+        self.profiler.disable()
+        self.profiler.dump_stats(self.filename)
+        logger.info("Startup took " + ", ".join(f"{phase} {elapsed:.2f}s" for phase, elapsed in self.phases)
+                    + f", profile written to {self.filename}")
+
+async def wait_for_signal():
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+    logger.warning("Received shutdown signal. Stopping the bot...")
+
+async def custom_run(app: BotClient, manager: BotManager, profile: StartupProfile):
+    # answer commands as early as possible, sessions and caches warm up in the background afterwards
     await app.start()
-    await manager.start()
-    await idle()
+    profile.mark("bot_online")
+    try:
+        await manager.start()
+        if manager.shards is not None:
+            await manager.shards.start()
+        profile.mark("ready")
+        report = asyncio.create_task(profile.finish(manager))
+        await wait_for_signal()
+        report.cancel()
+    finally:
+        await manager.shutdown()
+        await app.stop()
+
+async def run_worker(manager: BotManager, worker: Worker, profile: StartupProfile):
+    task = asyncio.create_task(worker.run())
+    report = asyncio.create_task(worker_ready(manager, profile))
+    stop = asyncio.create_task(wait_for_signal())
+    await asyncio.wait((task, stop), return_when=asyncio.FIRST_COMPLETED)
+    if task.done() and not task.cancelled() and task.exception() is not None:
+        logger.error(f"Worker stopped: {task.exception()}")
+    try:
+        # drain while the coordinator connection is still up to deliver messages
+        await manager.shutdown()
+    finally:
+        task.cancel()
+        stop.cancel()
+        report.cancel()
+        await asyncio.gather(task, stop, report, return_exceptions=True)
 
-def handle_shutdown(signum, frame):
-    logger.warning(f"Received shutdown signal {signum}. Stopping the bot...")
-    if manager:
-        asyncio.run(manager.shutdown())
-    if app:
-        asyncio.run(app.stop())
-    sys.exit(0)
+async def worker_ready(manager: BotManager, profile: StartupProfile):
+    # the manager starts once the coordinator connection is up
+    await manager.started.wait()
+    profile.mark("ready")
+    await profile.finish(manager)
 
 def main():
     global manager, app
-
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--worker", type=int, help="run as summary worker with this shard number")
+    parser.add_argument("--profile-startup", action="store_true",
+                        help="log how long each startup phase took and write a cProfile of startup")
+    args = parser.parse_args()
+    worker = args.worker
+    profile = StartupProfile(args.profile_startup, "startup.prof" if worker is None else f"startup_worker{worker}.prof")
+    profile.mark("imports")
 
     config = load_config("Bot_config.json")
     phrase = config.get("phrase") or "Provide a concise summary of those messages in a language of original"
@@ -45,13 +118,74 @@ def main():
     api_hash = config.get("api_hash")
     bot_token = config.get("bot_token")
     openai_api = config.get("openai_api_key")
+    openai_base_url = config.get("openai_base_url")
+    llm_concurrency = config.get("llm_concurrency", 5)
+    llm_timeout = config.get("llm_timeout", 120)
+    llm_max_retries = config.get("llm_max_retries", 4)
+    max_sessions = config.get("max_sessions", 20)
+    session_idle_timeout = config.get("session_idle_timeout", 900)
+    message_cache = config.get("message_cache", True)
+    storage = config.get("storage", "sqlite")
+    chunk_tokens = config.get("chunk_tokens", 12000)
+    summary_cache_size = config.get("summary_cache_size", 1024)
+    summary_cache_ttl = config.get("summary_cache_ttl", 180000)
+    summary_cache_disk = config.get("summary_cache_disk", True)
+    default_hours = config.get("default_hours", 0)
+    schedule_jitter = config.get("schedule_jitter", 300)
+    queue_workers = config.get("queue_workers", 5)
+    user_weights = config.get("user_weights", {})
+    telegram_rate = config.get("telegram_rate", 5)
+    bot_rate = config.get("bot_rate", 25)
+    llm_rpm = config.get("llm_rpm")
+    llm_tpm = config.get("llm_tpm")
+    stream = config.get("stream", True)
+    stream_edit_interval = config.get("stream_edit_interval", 2)
+    max_transcript_chars = config.get("max_transcript_chars", 400000)
+    skip_bots = config.get("skip_bots", True)
+    metrics_host = config.get("metrics_host", "127.0.0.1")
+    metrics_port = config.get("metrics_port")
+    digest = config.get("digest", True)
+    digest_chat_tokens = config.get("digest_chat_tokens", 1500)
+    digest_token_budget = config.get("digest_token_budget", 8000)
+    chat_index_ttl = config.get("chat_index_ttl", 3600)
+    shutdown_timeout = config.get("shutdown_timeout", 60)
+    cheap_model = config.get("cheap_model")
+    verbatim_messages = config.get("verbatim_messages", 3)
+    verbatim_tokens = config.get("verbatim_tokens", 150)
+    cheap_tokens = config.get("cheap_tokens", 4000)
+    premium_chats = config.get("premium_chats", [])
+    summary_bucket_hours = config.get("summary_bucket_hours", 0)
+    bucket_min_tokens = config.get("bucket_min_tokens", 4000)
+    enrich = config.get("enrich", [])
+    enrich_workers = config.get("enrich_workers", 2)
+    enrich_max_mb = config.get("enrich_max_mb", 20)
+    enrich_timeout = config.get("enrich_timeout", 20)
+    enrich_max_files = config.get("enrich_max_files", 30)
+    whisper_model = config.get("whisper_model", "base")
+    workers = config.get("workers", 0)
+    worker_socket = config.get("worker_socket") or f"{config_file}_workers.sock"
+    realtime = config.get("realtime", False)
+    live_buffer_size = config.get("live_buffer_size", 2000)
+    warm_sessions = config.get("warm_sessions", 5)
+    bot_chat_rate = config.get("bot_chat_rate", 1)
+    bot_chat_burst = config.get("bot_chat_burst", 3)
+    shared_ingest_ttl = config.get("shared_ingest_ttl", 120)
 
     if not api_id or not api_hash or not bot_token or not model:
         logger.error("API ID, API Hash, Bot token, or Model not found in the configuration.")
         sys.exit(1)
 
 
-    app = BotClient("Bot_session", api_id=api_id, api_hash=api_hash, bot_token=bot_token)
+    cache_file = config_file
+    if worker is not None:
+        # every worker keeps its own caches for the users of its shard
+        cache_file = f"{config_file}_worker{worker}"
+        llm_rpm = llm_rpm / workers if llm_rpm else llm_rpm
+        llm_tpm = llm_tpm / workers if llm_tpm else llm_tpm
+        metrics_port = metrics_port + 1 + worker if metrics_port else metrics_port
+        app = RemoteBot()
+    else:
+        app = BotClient("Bot_session", api_id=api_id, api_hash=api_hash, bot_token=bot_token)
 
 
     manager = BotManager(
@@ -62,17 +196,74 @@ def main():
         json_file=f"{config_file}.json",
         phrase=phrase,
         model=model,
+        openai_base_url=openai_base_url,
+        llm_concurrency=llm_concurrency,
+        llm_timeout=llm_timeout,
+        llm_max_retries=llm_max_retries,
+        max_sessions=max_sessions,
+        session_idle_timeout=session_idle_timeout,
+        message_cache_file=f"{cache_file}_messages.db" if message_cache else None,
+        storage=storage,
+        chunk_tokens=chunk_tokens,
+        summary_cache_size=summary_cache_size,
+        summary_cache_ttl=summary_cache_ttl,
+        summary_cache_file=f"{cache_file}_summaries.db" if summary_cache_disk else None,
+        default_hours=default_hours,
+        schedule_jitter=schedule_jitter,
+        queue_workers=queue_workers,
+        user_weights=user_weights,
+        telegram_rate=telegram_rate,
+        bot_rate=bot_rate,
+        llm_rpm=llm_rpm,
+        llm_tpm=llm_tpm,
+        stream=stream,
+        stream_edit_interval=stream_edit_interval,
+        max_transcript_chars=max_transcript_chars,
+        skip_bots=skip_bots,
+        metrics_host=metrics_host,
+        metrics_port=metrics_port,
+        digest=digest,
+        digest_chat_tokens=digest_chat_tokens,
+        digest_token_budget=digest_token_budget,
+        chat_index_ttl=chat_index_ttl,
+        live_buffer_file=f"{cache_file}_live.json" if realtime and (worker is not None or not workers) else None,
+        live_buffer_size=live_buffer_size,
+        jobs_file=f"{cache_file}_jobs.json",
+        shutdown_timeout=shutdown_timeout,
+        cheap_model=cheap_model,
+        verbatim_messages=verbatim_messages,
+        verbatim_tokens=verbatim_tokens,
+        cheap_tokens=cheap_tokens,
+        premium_chats=premium_chats,
+        summary_bucket_hours=summary_bucket_hours,
+        bucket_min_tokens=bucket_min_tokens,
+        enrich_extractors=enrich,
+        enrich_cache_file=f"{cache_file}_media.db",
+        enrich_workers=enrich_workers,
+        enrich_max_mb=enrich_max_mb,
+        enrich_timeout=enrich_timeout,
+        enrich_max_files=enrich_max_files,
+        whisper_model=whisper_model,
+        warm_sessions=warm_sessions,
+        bot_chat_rate=bot_chat_rate,
+        bot_chat_burst=bot_chat_burst,
+        shared_ingest_ttl=shared_ingest_ttl,
     )
+    profile.mark("configured")
+
 
+    if worker is not None:
+        asyncio.run(run_worker(manager, Worker(manager, worker_socket, worker, workers), profile))
+        return
+    if workers:
+        manager.shards = Coordinator(manager, worker_socket, workers, [sys.executable, os.path.abspath(__file__)])
 
     register_handlers(app, manager, authorized_users)
-    app.run(custom_run(app, manager))
+    app.run(custom_run(app, manager, profile))
     
 
 
 if __name__ == "__main__":
-    signal.signal(signal.SIGINT, handle_shutdown)
-    signal.signal(signal.SIGTERM, handle_shutdown)
     try:
         main()
     except (KeyboardInterrupt, SystemExit):
@@ -1,110 +1,218 @@
 import os
-import phonenumbers
 from pyromod import Client as BotClient
-import json
-from pyrogram.errors import MessageNotModified
-from openai import OpenAI
-from pyrogram import Client, enums
+from src.llm import LLMClient
+from src.session_pool import SessionPool
+from src.message_cache import MessageCache, is_global_chat
+from src.storage import create_storage, write_json_atomic
+from src.registry import Registry, UserRecord
+from src.summary_cache import SummaryCache, make_key
+from src.scheduler import Scheduler
+from src.rate_limit import TokenBucket
+from src.work_queue import FairQueue
+from src.chat_index import ChatIndex
+from src.live_buffer import LiveBuffer, LiveIngest
+from src.delivery import ProgressiveMessage, split_text
+from src.outbox import Outbox
+from src.extract import MessageFilter, extract_record
+from src.metrics import (ACTIVE_SESSIONS, CACHE_REQUESTS, FLOOD_WAITS, MESSAGES_FETCHED, OUTBOX_DEPTH, QUEUE_DEPTH,
+                         ROUTE_SECONDS, span, start_metrics_server)
+from src.routing import Router, compact
+from src.enrich import Enricher, create_extractors
+from src.buckets import TimedMessages, block_label, plan_window, FANOUT
+from src.chunking import TokenCounter, chunk_messages, get_token_counter, split_messages
+from pyrogram import Client
 import asyncio
+import json
+import random
+import re
+import time
 from pyrogram.errors import FloodWait
 import logging
+from functools import partial
 from datetime import datetime, timedelta, timezone
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
-def remove_duplicates(input_list):
-    return list(set(input_list))
-async def summarise(messages, api_key, phrase, model):
-    if not messages:
-        return "No messages"
-    try:
-        client = OpenAI(api_key=api_key)
-        chat_messages = [{"role": "user", "content": phrase}, {"role": "user", "content": messages}, {"role": "user", "content": "Processed:"}]
-        chat_completion = client.chat.completions.create(messages=chat_messages, model=model, store=False)
-        return chat_completion.choices[0].message.content
-    except Exception as e:
-        logger.error(f"Error calling OpenAI API, retrying in 60 seconds: {e}")
-        await asyncio.sleep(60)
-        client = OpenAI(api_key=api_key)
-        chat_messages = [{"role": "user", "content": phrase}, {"role": "user", "content": messages}, {"role": "user", "content": "Processed:"}]
-        chat_completion = client.chat.completions.create(messages=chat_messages, model=model, store=False)
-        return chat_completion.choices[0].message.content
-async def parse_chats(client: Client, limit: int = 50) -> str:
-    result = []
-    counter = 0
-    try:
-        async for dialog in client.get_dialogs():
-            if  counter >= limit:
-                break
+MERGE_PHRASE = ("Those are summaries of consecutive parts of one chat. Combine them into a single concise summary "
+                "in the language of the original")
+BUCKET_PHRASE = ("Those are consecutive time periods of one chat, each given as a summary or as the messages "
+                 "themselves. Combine them into a single concise summary in the language of the original")
+# buckets this small are passed on as messages instead of getting their own summary
+LEAF_TOKENS = 400
+# get_chat calls in flight at once when resolving a batch of chats
+RESOLVE_CONCURRENCY = 8
+DIGEST_PHRASE = ("Summarise each chat below separately. Start the summary of every chat with a line containing only "
+                 "### and the chat number, e.g. ### 2, and keep the chats in the given order")
+DIGEST_SECTION = re.compile(r"^[ \t]*###[ \t]*(\d+)(?:[ \t]+(.*?))?[ \t]*$", re.MULTILINE)
+def build_digest_prompt(entries: list) -> str:
+    # the title gets its own line so the header the model copies is just "### n"
+    return "\n\n".join(f"### {number}\nChat: {entry.title}\n{entry.messages}" for number, entry in enumerate(entries, 1))
+def digest_header(match, titles: list) -> bool:
+    number = int(match.group(1))
+    if not 1 <= number <= len(titles):
+        return False
+    # models still like to repeat the chat title after the number
+    label = (match.group(2) or "").strip(" -:").removeprefix("Chat:").strip()
+    return not label or label.casefold() == str(titles[number - 1]).strip().casefold()
+def split_digest(text: str, titles: list) -> dict:
+    sections = {}
+    # only headers of chats that were asked for end a section, a stray "### 2026" stays part of the text
+    matches = [i for i in DIGEST_SECTION.finditer(text) if digest_header(i, titles)]
+    for index, match in enumerate(matches):
+        end = matches[index + 1].start() if index + 1 < len(matches) else len(text)
+        sections.setdefault(int(match.group(1)), text[match.end():end].strip())
+    return sections
+class DigestEntry:
+    __slots__ = ("chat_id", "title", "messages", "tokens", "summary")
 
-            try:
-                if dialog.chat.type == enums.ChatType.PRIVATE:
-                    name = f"{'Deleted Account' if dialog.chat.first_name is None else dialog.chat.first_name}"
-                    if dialog.chat.last_name:
-                        name += f" {dialog.chat.last_name}"
-                else:
-                    name = dialog.chat.title or "Unnamed Chat"
-
-                result.append(f"{name}: `{dialog.chat.id}`")
-                counter+=1
-                await asyncio.sleep(1)
-
-            except AttributeError:
-                continue
+    def __init__(self, chat_id: int, title: str, messages: str | None, tokens: int = 0, summary: str = None):
+        self.chat_id = chat_id
+        self.title = title
+        self.messages = messages
+        self.tokens = tokens
+        self.summary = summary
+class PendingSummary:
+    __slots__ = ("user_id", "hours", "since", "chats", "task")
 
-    except FloodWait as e:
-        logger.error(f"FloodWait: {e.value} seconds")
-        await asyncio.sleep(e.value)
-
-    except Exception as e:
-        logger.error(f"Error: {str(e)}")
-        raise
+    def __init__(self, user_id: int, hours: int, since: datetime, chats: list, task: asyncio.Task):
+        self.user_id = user_id
+        self.hours = hours
+        self.since = since
+        self.chats = chats
+        self.task = task
 
-    return "\n".join(result)
-async def parse_messages(client: Client, chat_id: int, last_time: datetime) -> str:
+    def checkpoint(self) -> dict:
+        return {"user_id": self.user_id, "hours": self.hours, "since": self.since.timestamp(), "chats": self.chats}
+async def stream_completion(llm: LLMClient, chat_messages: list, model, on_progress):
+    text = ""
+    async for delta in llm.stream(chat_messages, model):
+        text += delta
+        on_progress(text)
+    return text
+async def summarise_once(messages, llm: LLMClient, phrase, model, cache: SummaryCache = None, on_progress=None):
+    chat_messages = [{"role": "user", "content": phrase}, {"role": "user", "content": messages}, {"role": "user", "content": "Processed:"}]
+    if on_progress is None:
+        compute = lambda: llm.complete(chat_messages, model)
+    else:
+        compute = lambda: stream_completion(llm, chat_messages, model, on_progress)
+    if cache is None:
+        return await compute()
+    return await cache.get_or_compute(make_key(model, phrase, messages), compute)
+async def summarise(messages, llm: LLMClient, phrase, model, chunk_tokens: int = None, cache: SummaryCache = None,
+                    on_progress=None):
+    if not messages:
+        return "No messages"
+    if not chunk_tokens:
+        return await summarise_once(messages, llm, phrase, model, cache, on_progress)
+    counter = get_token_counter(model)
+    chunks = chunk_messages(split_messages(messages), counter, chunk_tokens)
+    if len(chunks) == 1:
+        return await summarise_once(chunks[0], llm, phrase, model, cache, on_progress)
+    logger.info(f"Summarising {len(chunks)} chunks concurrently")
+    partials = await asyncio.gather(*[summarise_once(i, llm, phrase, model, cache) for i in chunks])
+    return await merge_summaries(partials, llm, model, counter, chunk_tokens, cache, on_progress)
+async def merge_summaries(partials: list, llm: LLMClient, model, counter: TokenCounter, chunk_tokens: int,
+                          cache: SummaryCache = None, on_progress=None, phrase: str = MERGE_PHRASE):
+    while True:
+        groups = chunk_messages(partials, counter, chunk_tokens)
+        if len(groups) == 1:
+            return await summarise_once(groups[0], llm, phrase, model, cache, on_progress)
+        partials = await asyncio.gather(*[summarise_once(i, llm, phrase, model, cache) for i in groups])
+async def summarise_part(text: str, llm: LLMClient, phrase, model, chunk_tokens: int, cache: SummaryCache):
+    if not text:
+        return None
+    if get_token_counter(model).count(text) <= LEAF_TOKENS:
+        return compact(text)
+    return await summarise(text, llm, phrase, model, chunk_tokens, cache)
+async def summarise_block(timed: TimedMessages, start: int, span: int, bucket: int, llm: LLMClient, phrase, model,
+                          chunk_tokens: int, cache: SummaryCache):
+    text = timed.between(start, start + span)
+    if span == bucket or get_token_counter(model).count(text) <= chunk_tokens:
+        # quiet blocks fit one request, only busy ones are split into smaller buckets
+        return await summarise_part(text, llm, phrase, model, chunk_tokens, cache)
+    step = span // FANOUT
+    children = await asyncio.gather(*[summarise_block(timed, start + i * step, step, bucket, llm, phrase, model,
+                                                      chunk_tokens, cache) for i in range(FANOUT)])
+    parts = [f"{block_label(start + i * step, start + (i + 1) * step)}\n{child}"
+             for i, child in enumerate(children) if child]
+    if len(parts) <= 1:
+        return next((i for i in children if i), None)
+    # inputs of closed blocks never change, so the cache answers this on every later request
+    return await summarise_once("\n\n".join(parts), llm, BUCKET_PHRASE, model, cache)
+async def summarise_window(messages: str, since: float, now: float, bucket: int, llm: LLMClient, phrase, model,
+                           chunk_tokens: int, cache: SummaryCache, on_progress=None):
+    # only the partial buckets at both ends are new, closed buckets and blocks come from the summary cache
+    timed = TimedMessages(messages)
+    head, blocks, tail = plan_window(since, now, bucket)
+    segments = [(head[0], head[1], None)] + [(start, start + span, span) for start, span in blocks]
+    if tail is not None:
+        segments.append((tail[0], tail[1], None))
+    summaries = await asyncio.gather(*[
+        summarise_block(timed, start, span, bucket, llm, phrase, model, chunk_tokens, cache) if span else
+        summarise_part(timed.between(start, end), llm, phrase, model, chunk_tokens, cache)
+        for start, end, span in segments])
+    parts = [f"{block_label(start, end)}\n{summary}" for (start, end, _), summary in zip(segments, summaries) if summary]
+    if len(parts) <= 1:
+        return await summarise(messages, llm, phrase, model, chunk_tokens, cache, on_progress)
+    return await merge_summaries(parts, llm, model, get_token_counter(model), chunk_tokens, cache, on_progress,
+                                 BUCKET_PHRASE)
+def cap_lines(lines: list, max_chars: int) -> list:
+    # keep the newest messages that fit into the budget
+    total = 0
+    for i in range(len(lines) - 1, -1, -1):
+        total += len(lines[i]) + 1
+        if total > max_chars:
+            logger.warning(f"Transcript over {max_chars} chars, dropping {i + 1} oldest messages")
+            return lines[i + 1:]
+    return lines
+async def parse_messages(client: Client, chat_id: int, last_time: datetime, cache: MessageCache = None,
+                         limiter: TokenBucket = None, max_chars: int = 400000, skip_bots: bool = True,
+                         enricher: Enricher = None, user_id: int = None) -> str:
     messages = []
+    media = []
+    after_date = max(last_time, datetime.now(timezone.utc) - timedelta(hours=48))
+    state = await cache.state(user_id, chat_id) if cache is not None else None
+    # only trust the watermark if the cached history reaches back far enough for this window
+    watermark = state[0] if state is not None and state[1] <= after_date.timestamp() else None
+    if cache is not None:
+        CACHE_REQUESTS.inc(cache="messages", result="hit" if watermark is not None else "miss")
+    max_id = watermark or 0
+    covered_from = after_date.timestamp()
+    message_filter = MessageFilter(skip_bots=skip_bots)
+    fetched = 0
+    total_chars = 0
     try:
-        after_date = last_time
         async for message in client.get_chat_history(chat_id):
             if client.is_initialized and not client.is_connected:
                 await client.connect()
-            message.date = message.date.astimezone(timezone.utc)
-            if message.date < after_date or message.date < (datetime.now(timezone.utc) - timedelta(hours=48)):
+            # get_chat_history pulls pages of 100, account for each page request
+            if limiter is not None and fetched % 100 == 0:
+                await limiter.acquire()
+            fetched += 1
+            if watermark is not None and message.id <= watermark:
+                covered_from = state[1]
+                break
+            max_id = max(max_id, message.id)
+            date = message.date.astimezone(timezone.utc)
+            if date < after_date:
+                # the window ended before the watermark, so the cache is no longer contiguous
+                break
+            if total_chars > max_chars:
+                logger.warning(f"Chat {chat_id} over {max_chars} chars, not fetching older messages")
+                covered_from = messages[-1][1]
                 break
 
             try:
-                timestamp = message.date
-                sender = message.from_user.first_name if message.from_user else "Unknown"
-
-                media_info = []
-
-                if message.audio:
-                    media_info.append("[AUDIO]")
-                if message.voice:
-                    media_info.append("[VOICE]")
-                if message.video:
-                    media_info.append("[VIDEO]")
-                if message.photo:
-                    media_info.append("[PHOTO]")
-                if message.document:
-                    media_info.append(f"[FILE: {message.document.file_name}]")
-                if message.sticker:
-                    media_info.append("[STICKER]")
-                if message.animation:
-                    media_info.append("[GIF]")
-                if message.video_note:
-                    media_info.append("[VIDEO NOTE]")
-
-
-                text = message.text or message.caption or ""
-                if media_info:
-                    text += f" {' '.join(media_info)}"
-
-                if text.strip():
-                    messages.append(f"[{timestamp}] {sender}: {text}")
-
+                message.date = date
+                record = extract_record(message, message_filter)
+                if record is not None:
+                    line = record.line()
+                    total_chars += len(line) + 1
+                    messages.append((record.message_id, date.timestamp(), line))
+                    if enricher is not None and len(media) < enricher.max_files and enricher.wants(message):
+                        media.append((message, len(messages) - 1))
 
             except AttributeError as e:
                 logger.warning(f"Skipping message due to missing attribute: {str(e)}")
@@ -113,86 +221,331 @@ async def parse_messages(client: Client, chat_id: int, last_time: datetime) -> s
     except Exception as e:
         logger.error(f"Error retrieving messages: {str(e)}")
         raise e
+    finally:
+        MESSAGES_FETCHED.inc(fetched)
 
-    if not messages:
+    if media:
+        with span("enrich", chat=chat_id, files=len(media)):
+            texts, unfinished = await enricher.enrich(client, [i[0] for i in media])
+        for message, index in media:
+            if message.id in texts:
+                message_id, date, line = messages[index]
+                messages[index] = (message_id, date, f"{line} {texts[message.id]}")
+        if unfinished:
+            # keep the watermark below media still being processed, the next fetch reads those messages
+            # again and finds their text in the media cache
+            max_id = min(max_id, min(unfinished) - 1)
+        del media
+
+    if cache is None:
+        lines = [i[2] for i in reversed(messages)]
+    else:
+        await cache.store(user_id, chat_id, messages, max_id, covered_from)
+        since = datetime.fromtimestamp(max(covered_from, after_date.timestamp()), timezone.utc)
+        lines = await cache.lines(user_id, chat_id, since)
+        logger.debug(f"Fetched {len(messages)} new messages for chat {chat_id}, {len(lines)} in window")
+    del messages
+
+    return join_lines(lines, max_chars)
+
+
+def join_lines(lines: list, max_chars: int) -> str:
+    if not lines:
         return f"No messages found"
 
-    return "\n".join(reversed(messages))
-def remove_element_in_place(lst, element):
-    try:
-        idx = lst.index(element)
-        for i in range(idx, len(lst) - 1):
-            lst[i] = lst[i + 1]
-        lst.pop()
-        return lst
-    except ValueError:
-        return lst
+    return "\n".join(cap_lines(lines, max_chars))
 
 class BotManager:
-    def __init__(self, app: BotClient, api_id, phrase: str, model: str, api_hash, openai_api, json_file="users_config.json"):
+    def __init__(self, app: BotClient, api_id, phrase: str, model: str, api_hash, openai_api, json_file="users_config.json",
+                 openai_base_url=None, llm_concurrency: int = 5, llm_timeout: float = 120.0, llm_max_retries: int = 4,
+                 max_sessions: int = 20, session_idle_timeout: float = 900.0, message_cache_file=None,
+                 storage: str = "sqlite", chunk_tokens: int = 12000, summary_cache_size: int = 1024,
+                 summary_cache_ttl: float = 180000.0, summary_cache_file=None, default_hours: int = 0,
+                 schedule_jitter: float = 300.0, queue_workers: int = 5, user_weights: dict = None,
+                 telegram_rate: float = 5.0, bot_rate: float = 25.0, llm_rpm: float = None, llm_tpm: float = None,
+                 stream: bool = True, stream_edit_interval: float = 2.0,
+                 max_transcript_chars: int = 400000, skip_bots: bool = True, metrics_host: str = "127.0.0.1",
+                 metrics_port: int = None, digest: bool = True, digest_chat_tokens: int = 1500,
+                 digest_token_budget: int = 8000, chat_index_ttl: float = 3600.0, live_buffer_file=None,
+                 live_buffer_size: int = 2000, jobs_file=None, shutdown_timeout: float = 60.0,
+                 cheap_model: str = None, verbatim_messages: int = 3, verbatim_tokens: int = 150,
+                 cheap_tokens: int = 4000, premium_chats=(), summary_bucket_hours: float = 0,
+                 bucket_min_tokens: int = 4000, enrich_extractors=(), enrich_cache_file=None, enrich_workers: int = 2,
+                 enrich_max_mb: float = 20, enrich_timeout: float = 20.0, enrich_max_files: int = 30,
+                 whisper_model: str = "base", warm_sessions: int = 5, bot_chat_rate: float = 1.0,
+                 bot_chat_burst: float = 3, shared_ingest_ttl: float = 120.0):
         self.json_file = json_file
-        self.schedules = {}
+        self.storage = create_storage(storage, json_file)
+        self.registry = Registry()
         self.api_id = api_id
         self.api_hash = api_hash
         self.openai_api = openai_api
         self.app = app
-        self.semaphore = asyncio.Semaphore(5)
+        self.work_queue = FairQueue(workers=queue_workers, weights=user_weights)
+        self.telegram_limiter = TokenBucket("Telegram user API", telegram_rate)
+        self.bot_limiter = TokenBucket("Telegram bot API", bot_rate)
+        self.outbox = Outbox(app, self.bot_limiter, bot_chat_rate, bot_chat_burst)
+        self.chat_index = ChatIndex(self.telegram_limiter, ttl=chat_index_ttl)
         self.time_limit = 12
         self.phrase = phrase
         self.model = model
+        self.default_hours = default_hours
+        self.schedule_jitter = schedule_jitter
+        self.scheduler = Scheduler(self.start_digest)
+        self.running_tasks = {}
+        self.chunk_tokens = chunk_tokens
+        extractors = create_extractors(enrich_extractors, whisper_model)
+        self.enricher = Enricher(extractors, SummaryCache(max_entries=4096, ttl=30 * 86400, filename=enrich_cache_file,
+                                                          name="media"),
+                                 workers=enrich_workers, max_file_size=int(enrich_max_mb * 2 ** 20),
+                                 timeout=enrich_timeout, max_files=enrich_max_files) if extractors else None
+        self.bucket_seconds = int(summary_bucket_hours * 3600)
+        self.bucket_min_tokens = bucket_min_tokens
+        self.router = Router(model, cheap_model, verbatim_messages, verbatim_tokens, cheap_tokens, premium_chats)
+        self.stream = stream
+        self.stream_edit_interval = stream_edit_interval
+        self.max_transcript_chars = max_transcript_chars
+        self.skip_bots = skip_bots
+        self.metrics_host = metrics_host
+        self.metrics_port = metrics_port
+        self.metrics_server = None
+        self.digest = digest
+        self.digest_chat_tokens = digest_chat_tokens
+        self.digest_token_budget = digest_token_budget
+        self.llm = LLMClient(api_key=openai_api, base_url=openai_base_url, max_concurrency=llm_concurrency,
+                             timeout=llm_timeout, max_retries=llm_max_retries,
+                             request_limiter=TokenBucket("OpenAI requests", llm_rpm / 60) if llm_rpm else None,
+                             token_limiter=TokenBucket("OpenAI tokens", llm_tpm / 60, llm_tpm) if llm_tpm else None)
+        self.session_pool = SessionPool(api_id=api_id, api_hash=api_hash, max_sessions=max_sessions,
+                                        idle_timeout=session_idle_timeout)
+        self.message_cache = MessageCache(message_cache_file) if message_cache_file else None
+        self.shared_ingest_ttl = shared_ingest_ttl
+        # chats tracked by several users: history reads in flight and when each chat was last read
+        self.fetching: dict[int, asyncio.Task] = {}
+        self.ingested: dict[int, float] = {}
+        self.live = LiveIngest(LiveBuffer(live_buffer_file, live_buffer_size, skip_bots), self.session_pool,
+                               self.telegram_limiter) if live_buffer_file else None
+        self.background_tasks = set()
+        self.shards = None
+        self.jobs_file = jobs_file
+        self.shutdown_timeout = shutdown_timeout
+        self.warm_sessions = warm_sessions
+        self.warm_task = None
+        self.started = asyncio.Event()
+        self.accepting = True
+        self.inflight = set()
+        QUEUE_DEPTH.set_function(self.work_queue.depth)
+        OUTBOX_DEPTH.set_function(self.outbox.depth)
+        ACTIVE_SESSIONS.set_function(lambda: sum(i.client.is_connected for i in self.session_pool.sessions.values()))
+        self.summary_cache = SummaryCache(max_entries=summary_cache_size, ttl=summary_cache_ttl,
+                                          filename=summary_cache_file) if summary_cache_size else None
 
     async def start(self):
         try:
-            with open(self.json_file, 'r') as f:
-                self.schedules = json.load(f)
-        except FileNotFoundError:
-            logger.warning("No previous configs found")
-            with open(self.json_file, 'w') as f:
-                json.dump({}, f)
-                self.schedules = {}
+            self.registry.load(await self.storage.load())
         except Exception as e:
             logger.error(f"Unknown error in BotManager.start: {e}")
             raise e
+        now = time.time()
+        for record in self.registry:
+            next_run = self.restore_next_run(record, now)
+            if next_run is not None:
+                self.scheduler.schedule(record.user_id, next_run)
+        self.scheduler.start()
+        await self.start_services(list(self.registry))
+
+    async def start_worker(self, owns):
+        # workers only summarise for their shard, schedules and storage writes stay with the coordinator
+        self.registry.load(await self.storage.load())
+        await self.start_services([i for i in self.registry if owns(i.user_id)])
+
+    async def start_services(self, users):
+        await self.session_pool.start()
+        self.work_queue.start()
+        if self.live is not None:
+            self.live.buffer.load()
+            for record in users:
+                if record.chats:
+                    self.listen(record.user_id)
+        self.resume_jobs()
+        if self.shards is None:
+            self.warm_task = asyncio.create_task(self.warm_up(users))
+            self.background_tasks.add(self.warm_task)
+            self.warm_task.add_done_callback(self.background_tasks.discard)
+        if self.metrics_port:
+            self.metrics_server = await start_metrics_server(self.metrics_host, self.metrics_port)
+        self.started.set()
+
+    async def warm_up(self, users):
+        # runs once the bot already answers, so the first /now doesn't pay for imports and logins
+        with span("warm_up"):
+            try:
+                await self.llm.warm_up()
+                await asyncio.to_thread(get_token_counter, self.model)
+            except Exception as e:
+                logger.warning(f"Error warming up the LLM client: {e}")
+            # most recently active users are the likeliest to send the next command
+            recent = sorted((i for i in users if i.chats), key=lambda i: i.last_called or "", reverse=True)
+            for record in recent[:min(self.warm_sessions, self.session_pool.max_sessions)]:
+                try:
+                    await self.chat_index.ensure_fresh(record.user_id, partial(self.open_session, record.user_id),
+                                                       wait=True)
+                except Exception as e:
+                    logger.warning(f"Error warming up the session of user {record.user_id}: {e}")
+        logger.info(f"Warmed up sessions of {min(len(recent), self.warm_sessions)} users")
+
+    def resume_jobs(self):
+        if self.jobs_file is None or not os.path.exists(self.jobs_file):
+            return
+        try:
+            with open(self.jobs_file, 'r') as f:
+                jobs = json.load(f)
+        except Exception as e:
+            logger.error(f"Could not read checkpointed jobs from {self.jobs_file}: {e}")
+            jobs = []
+        os.remove(self.jobs_file)
+        for job in jobs:
+            if job["user_id"] in self.registry:
+                task = asyncio.create_task(self.resume_job(job))
+                self.background_tasks.add(task)
+                task.add_done_callback(self.background_tasks.discard)
+        logger.info(f"Resuming {len(jobs)} checkpointed summaries")
+
+    async def resume_job(self, job: dict):
+        user_id = job["user_id"]
+        try:
+            await self.send_message(user_id, "Resuming the summary interrupted by the restart...", status=True)
+            await self.summarise_user_chats(user_id, job["hours"], datetime.fromtimestamp(job["since"], timezone.utc),
+                                            job["chats"])
+        except Exception as e:
+            logger.error(f"Error resuming summary for user {user_id}: {e}")
+            await self.send_message(user_id, "Unknown error. Please try again later", status=True)
+
+    def listen(self, user_id: int):
+        # subscribing catches up on history first, which must not hold up the caller
+        task = asyncio.create_task(self.subscribe_live(user_id))
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+
+    async def subscribe_live(self, user_id: int):
+        record = self.registry.get(user_id)
+        if record is None:
+            return
+        try:
+            await self.live.subscribe(user_id, record.phone, list(record.chats))
+        except Exception as e:
+            logger.error(f"Error subscribing user {user_id} to live updates: {e}")
+
+    def jitter(self, hours: float) -> float:
+        return random.uniform(0, min(self.schedule_jitter, hours * 360))
+
+    async def save_user(self, record: UserRecord):
+        await self.storage.save_user(str(record.user_id), record.to_list())
+
+    def restore_next_run(self, record: UserRecord, now: float):
+        hours = record.hours
+        if not hours or hours <= 0:
+            return None
+        if record.next_run:
+            next_run = record.next_run
+        elif record.last_called:
+            next_run = datetime.fromisoformat(record.last_called).timestamp() + hours * 3600
+        else:
+            next_run = now + hours * 3600
+        if next_run < now:
+            # missed while the bot was down, catch up soon but spread the backlog out
+            next_run = now + random.uniform(0, self.schedule_jitter)
+        return next_run
+
+    async def set_schedule(self, user_id: int, hours: int):
+        record = self.registry.get(user_id)
+        if record is None:
+            logger.warning(f"user_id {user_id} not found")
+            await self.send_message(user_id, "User information not found! Please use /register!")
+            return
+        record.hours = hours
+        if hours > 0:
+            record.next_run = time.time() + hours * 3600 + self.jitter(hours)
+            self.scheduler.schedule(user_id, record.next_run)
+        else:
+            record.next_run = None
+            self.scheduler.unschedule(user_id)
+        await self.save_user(record)
+        logger.info(f"Set digest interval of user {user_id} to {hours} hours")
+
+    def start_digest(self, user_id: int):
+        if user_id in self.running_tasks:
+            logger.warning(f"Previous digest for user {user_id} still running, skipping")
+            record = self.registry.get(user_id)
+            if record is not None and record.hours and record.hours > 0:
+                # the scheduler dropped this run, without a new one the user never gets another digest
+                record.next_run = time.time() + record.hours * 3600 + self.jitter(record.hours)
+                self.scheduler.schedule(user_id, record.next_run)
+        else:
+            task = asyncio.create_task(self.run_digest(user_id))
+            self.running_tasks[user_id] = task
+            task.add_done_callback(lambda _: self.running_tasks.pop(user_id, None))
+
+    async def run_digest(self, user_id: int):
+        record = self.registry.get(user_id)
+        if record is None or not record.hours or record.hours <= 0:
+            return
+        now = time.time()
+        hours = record.hours
+        if record.last_called:
+            hours = (now - datetime.fromisoformat(record.last_called).timestamp()) / 3600
+        hours = min(48, max(1, round(hours)))
+        record.next_run = now + record.hours * 3600 + self.jitter(record.hours)
+        self.scheduler.schedule(user_id, record.next_run)
+        if record.chats:
+            logger.info(f"Running scheduled digest for user {user_id}")
+            await self.summarise_chats(user_id, hours)
+        else:
+            await self.save_user(record)
 
     async def add_user(self, user_id: int, hours: int):
         try:
-            if str(user_id) in self.schedules:
+            if user_id in self.registry:
                 logger.info(f"User {user_id} already exists.")
-                await self.app.send_message(user_id, "User already exists. Use command /remove to delete all of your data and then use /register.")
+                await self.send_message(user_id, "User already exists. Use command /remove to delete all of your data and then use /register.")
                 return
             user_reply = await self.app.ask(user_id, "Please provide your phone number in the format: +<phone number>")
             try:
+                import phonenumbers
                 phone = user_reply.text
                 tmp = phonenumbers.parse(phone)
                 if not phonenumbers.is_valid_number(tmp):
-                    await self.app.send_message(user_id, "Invalid phone number. Please try the /register command again.")
+                    await self.send_message(user_id, "Invalid phone number. Please try the /register command again.")
                     return
             except Exception as e:
                 raise e
-            hours = 666
-            item = [user_id, hours, None, phone, []]
-            self.schedules[str(user_id)] = item
-            with open(self.json_file, 'w') as f:
-                json.dump(self.schedules, f, indent=2)
-            await self.app.send_message(user_id, "Contact administrator for initial login.")
+            hours = hours or self.default_hours
+            record = UserRecord(user_id, hours, phone=phone)
+            if hours > 0:
+                record.next_run = time.time() + hours * 3600 + self.jitter(hours)
+                self.scheduler.schedule(user_id, record.next_run)
+            self.registry.add(record)
+            await self.save_user(record)
+            await self.send_message(user_id, "Contact administrator for initial login.")
             await self.list(user_id)
-            await self.app.send_message(user_id, "Great! You're all set to use this bot. To see the first chat IDs available in your account, use the /list command. To add new chats, use the /add command.")
+            await self.send_message(user_id, "Great! You're all set to use this bot. To see the first chat IDs available in your account, use the /list command. To add new chats, use the /add command.")
         except Exception as e:
             logger.error(f"Unknown error in BotManager.add_user: {e}")
             raise e
 
     async def add_chat_for_user(self, user_id: int, chat_id: int):
         try:
-            if str(user_id) not in self.schedules:
+            if user_id not in self.registry:
                 logger.info(f"User {user_id} not found.")
-                await self.app.send_message(user_id, "User not found. Please register first by using the /register command.")
+                await self.send_message(user_id, "User not found. Please register first by using the /register command.")
                 return
-            item = self.schedules[str(user_id)]
-            item[4].append(chat_id)
-            item[4] = remove_duplicates(item[4])
-            self.schedules[str(user_id)] = item
-            with open(self.json_file, 'w') as f:
-                json.dump(self.schedules, f, indent=2)
+            if not self.registry.add_chat(user_id, chat_id):
+                return
+            await self.save_user(self.registry.get(user_id))
+            if self.shards is not None:
+                await self.shards.call(user_id, "update_user")
+            elif self.live is not None:
+                self.listen(user_id)
             logger.info(f"Added new chat {chat_id} for user {user_id}")
         except Exception as e:
             logger.error(f"Unexpected error in BotManager.add_chat_for_user: {e}")
@@ -200,107 +553,334 @@ class BotManager:
 
     async def remove_chat_for_user(self, user_id: int, chat_id: int):
         try:
-            if str(user_id) not in self.schedules:
+            if user_id not in self.registry:
                 logger.info(f"User {user_id} not found.")
-                await self.app.send_message(user_id, "User not found. Please register first by using the /register command.")
+                await self.send_message(user_id, "User not found. Please register first by using the /register command.")
+                return
+            if not self.registry.remove_chat(user_id, chat_id):
                 return
-            item = self.schedules[str(user_id)]
-            item[4] = remove_element_in_place(item[4], chat_id)
-            item[4] = remove_duplicates(item[4])
-            self.schedules[str(user_id)] = item
-            with open(self.json_file, 'w') as f:
-                json.dump(self.schedules, f, indent=2)
+            await self.save_user(self.registry.get(user_id))
+            if self.shards is not None:
+                await self.shards.call(user_id, "update_user")
+            elif self.live is not None:
+                self.live.untrack(user_id, chat_id)
             logger.info(f"Removed chat {chat_id} for user {user_id}")
         except Exception as e:
             logger.error(f"Unexpected error in BotManager.add_chat_for_user: {e}")
             raise e
 
-    async def summarise_chat(self, chat_id: int, last_time: datetime, client: Client, user_id: int):
-        app = self.app
-        chat = await client.get_chat(str(chat_id))
-        hours_dt = datetime.now(timezone.utc) - last_time
-        hours = round(hours_dt.total_seconds() / 3600)
-        if hours > 48:
-            hours = 48
-        sent_message = await app.send_message(user_id, f"Generating summary for chat {chat.title}, please wait...\n")
-        messages = await parse_messages(client, chat_id, last_time)
-        if messages == "No messages found":
-            await app.edit_message_text(chat_id=sent_message.chat.id, message_id=sent_message.id,
-                                        text=f"No messages found in {chat.title} for the past {hours} hours.\n\n ")
+    async def summarise_chat(self, chat_id: int, last_time: datetime, client: Client, user_id: int,
+                             collect_small: bool = False, messages: str = None):
+        # history is fetched while the title is looked up and the placeholder goes out
+        fetch = None
+        if messages is None:
+            fetch = asyncio.create_task(self.fetch_messages(client, chat_id, last_time, user_id))
+        try:
+            chat = await self.get_chat_info(client, user_id, chat_id)
+            hours_dt = datetime.now(timezone.utc) - last_time
+            hours = round(hours_dt.total_seconds() / 3600)
+            if hours > 48:
+                hours = 48
+            if not collect_small:
+                sent_message = await self.send_message(user_id, f"Generating summary for chat {chat.title}, please wait...\n")
+            if fetch is not None:
+                messages = await fetch
+        finally:
+            if fetch is not None:
+                fetch.cancel()
+        route = None
+        if messages != "No messages found":
+            tokens = get_token_counter(self.model).count(messages)
+            route = self.router.route(chat_id, len(split_messages(messages)), tokens)
+        if collect_small:
+            # quiet chats are handed back to summarise_chats and packed into one digest request
+            if route is None:
+                return DigestEntry(chat_id, chat.title, None)
+            if route.verbatim:
+                self.router.record(route.name, tokens)
+                return DigestEntry(chat_id, chat.title, messages, tokens, compact(messages))
+            if tokens <= self.digest_chat_tokens:
+                self.router.record("digest", tokens)
+                return DigestEntry(chat_id, chat.title, messages, tokens)
+            sent_message = await self.send_message(user_id, f"Generating summary for chat {chat.title}, please wait...\n")
+        if route is not None:
+            self.router.record(route.name, tokens)
+        if route is None:
+            await self.edit_message(sent_message, f"No messages found in {chat.title} for the past {hours} hours.\n\n ")
+        elif route.verbatim:
+            # too little to be worth a model call, show the messages themselves
+            await ProgressiveMessage(self, user_id, sent_message,
+                                     f"Messages from the past {hours} hours in chat {chat.title}:\n ",
+                                     self.stream_edit_interval).finish(compact(messages))
         else:
+            progress = ProgressiveMessage(self, user_id, sent_message,
+                                          f"Summary for the past {hours} hours for chat {chat.title}:\n ",
+                                          self.stream_edit_interval)
             try:
-                result = await summarise(messages, self.openai_api, self.phrase, self.model)
+                with span("summarise", chat=chat_id, chars=len(messages), route=route.name), \
+                        ROUTE_SECONDS.time(route=route.name):
+                    if self.bucket_seconds and self.summary_cache is not None and self.chunk_tokens \
+                            and tokens > self.bucket_min_tokens:
+                        since = max(last_time, datetime.now(timezone.utc) - timedelta(hours=48)).timestamp()
+                        result = await summarise_window(messages, since, time.time(), self.bucket_seconds, self.llm,
+                                                        self.phrase, route.model, self.chunk_tokens, self.summary_cache,
+                                                        progress.update if self.stream else None)
+                    else:
+                        result = await summarise(messages, self.llm, self.phrase, route.model, self.chunk_tokens,
+                                                 self.summary_cache, progress.update if self.stream else None)
             except Exception as e:
-                logger.error(f"Error generating summary, timeout for 30 sec, Error: {e}")
-                await asyncio.sleep(60)
-                try:
-                    result = await summarise(messages, self.openai_api, self.phrase, self.model)
-                except Exception as e:
-                    logger.error(f"Error generating summary, sending to users, Error: {e}")
-                    await app.edit_message_text(chat_id=sent_message.chat.id, message_id=sent_message.id,
-                                                text=f"Unknown error while generating summary.\n ")
-                    raise e
-            try:
-                await app.edit_message_text(chat_id=sent_message.chat.id, message_id=sent_message.id,
-                                        text=f"Summary for the past {hours} hours for chat {chat.title}:\n {result}\n\n ")
-            except MessageNotModified:
-                pass
+                logger.error(f"Error generating summary, sending to users, Error: {e}")
+                await self.edit_message(sent_message, f"Unknown error while generating summary.\n ")
+                raise e
+            with span("deliver", chat=chat_id):
+                await progress.finish(result)
         logger.info(f"Summarised chat {chat.title} for user {user_id}")
+        return None
+
+    async def fetch_messages(self, client: Client, chat_id: int, last_time: datetime, user_id: int) -> str:
+        with span("parse_messages", chat=chat_id):
+            if chat_id in self.fetching and self.chat_index.confirmed(user_id, chat_id):
+                # another subscriber started reading this chat after summarise_chat_job looked, share that read
+                lines = await self.shared_lines(chat_id, last_time, user_id)
+                if lines is not None:
+                    return join_lines(lines, self.max_transcript_chars)
+            if not self.is_shared(chat_id) or chat_id in self.fetching:
+                # a read for a window this one doesn't fit in is already running, this one goes on its own
+                return await parse_messages(client, chat_id, last_time, self.message_cache, self.telegram_limiter,
+                                            self.max_transcript_chars, self.skip_bots, self.enricher, user_id)
+            task = self.fetching[chat_id] = asyncio.create_task(
+                parse_messages(client, chat_id, last_time, self.message_cache, self.telegram_limiter,
+                               self.max_transcript_chars, self.skip_bots, self.enricher, user_id))
+            try:
+                result = await asyncio.shield(task)
+            finally:
+                if self.fetching.get(chat_id) is task:
+                    self.fetching.pop(chat_id)
+            self.ingested[chat_id] = time.monotonic()
+            return result
+
+    async def stored_lines(self, chat_id: int, last_time: datetime, user_id: int) -> list | None:
+        lines = self.live.buffer.lines(user_id, chat_id, last_time) if self.live is not None else None
+        if lines is None and self.is_shared(chat_id):
+            lines = await self.shared_lines(chat_id, last_time, user_id)
+        return lines
+
+    async def confirm_chat(self, client: Client, user_id: int, chat_id: int):
+        # raises if the user's own session can no longer open the chat, otherwise renews their access
+        await self.telegram_limiter.acquire()
+        with span("get_chat", chat=chat_id):
+            chat = await client.get_chat(str(chat_id))
+        self.chat_index.put(user_id, chat)
+
+    def is_shared(self, chat_id: int) -> bool:
+        # only supergroups and channels look the same to every account, private chats and basic groups never are
+        return self.message_cache is not None and is_global_chat(chat_id) \
+            and len(self.registry.subscribers_of(chat_id)) > 1
+
+    async def shared_lines(self, chat_id: int, last_time: datetime, user_id: int) -> list | None:
+        # another subscriber read this chat moments ago or is reading it right now, take it from the cache
+        fresh = await self.shared_fresh(chat_id, last_time, user_id)
+        CACHE_REQUESTS.inc(cache="shared_chats", result="hit" if fresh else "miss")
+        if not fresh:
+            return None
+        return await self.message_cache.lines(user_id, chat_id,
+                                              max(last_time, datetime.now(timezone.utc) - timedelta(hours=48)))
+
+    async def shared_fresh(self, chat_id: int, last_time: datetime, user_id: int) -> bool:
+        fetching = self.fetching.get(chat_id)
+        if fetching is not None:
+            await asyncio.gather(asyncio.shield(fetching), return_exceptions=True)
+        read_at = self.ingested.get(chat_id)
+        if read_at is None or time.monotonic() - read_at > self.shared_ingest_ttl:
+            return False
+        state = await self.message_cache.state(user_id, chat_id)
+        since = max(last_time, datetime.now(timezone.utc) - timedelta(hours=48))
+        return state is not None and state[1] <= since.timestamp()
+
+    def warm_subscriber(self, chat_id: int, user_id: int) -> int:
+        # any subscriber with a connected session can read a shared chat, starting another one takes seconds
+        for candidate in [user_id, *self.registry.subscribers_of(chat_id)]:
+            entry = self.session_pool.sessions.get(candidate)
+            if entry is not None and entry.client.is_connected and candidate in self.registry \
+                    and self.chat_index.confirmed(candidate, chat_id):
+                return candidate
+        return user_id
+
+    def pack_digest(self, entries: list) -> list:
+        batches = []
+        current = []
+        current_tokens = 0
+        for entry in entries:
+            if entry.messages is None or entry.summary is not None:
+                continue
+            if current and current_tokens + entry.tokens > self.digest_token_budget:
+                batches.append(current)
+                current = []
+                current_tokens = 0
+            current.append(entry)
+            current_tokens += entry.tokens
+        if current:
+            batches.append(current)
+        return batches
+
+    async def summarise_digest_batch(self, batch: list) -> dict:
+        model = self.router.digest_model
+        if len(batch) == 1:
+            with ROUTE_SECONDS.time(route="digest"):
+                result = await summarise(batch[0].messages, self.llm, self.phrase, model, self.chunk_tokens,
+                                         self.summary_cache)
+            return {batch[0].chat_id: result}
+        with span("summarise_digest", chats=len(batch)), ROUTE_SECONDS.time(route="digest"):
+            result = await summarise_once(build_digest_prompt(batch), self.llm, f"{self.phrase}. {DIGEST_PHRASE}",
+                                          model, self.summary_cache)
+        sections = split_digest(result, [entry.title for entry in batch])
+        if len(sections) < len(batch):
+            logger.warning(f"Digest answer had {len(sections)} of {len(batch)} sections, summarising the rest separately")
+            missing = [entry for number, entry in enumerate(batch, 1) if number not in sections]
+            rest = await asyncio.gather(*[self.summarise_digest_batch([entry]) for entry in missing])
+            summaries = {entry.chat_id: sections[number] for number, entry in enumerate(batch, 1) if number in sections}
+            for i in rest:
+                summaries.update(i)
+            return summaries
+        return {entry.chat_id: sections[number] for number, entry in enumerate(batch, 1)}
+
+    async def deliver_digest(self, user_id: int, hours: int, entries: list):
+        sent_message = await self.send_message(user_id, f"Generating summary for {len(entries)} chats, please wait...\n")
+        futures = []
+        for batch in self.pack_digest(entries):
+            future, _ = await self.work_queue.submit(user_id, partial(self.summarise_digest_batch, batch),
+                                                     name=f"digest of {len(batch)} chats")
+            futures.append(future)
+        summaries = {}
+        try:
+            for i in await asyncio.gather(*futures):
+                summaries.update(i)
+        except Exception as e:
+            logger.error(f"Error generating digest, sending to users, Error: {e}")
+            await self.edit_message(sent_message, f"Unknown error while generating summary.\n ")
+            raise e
+        sections = []
+        for entry in entries:
+            if entry.messages is None:
+                sections.append(f"{entry.title}:\n No messages found for the past {hours} hours.")
+            elif entry.summary is not None:
+                sections.append(f"{entry.title}:\n {entry.summary}")
+            else:
+                sections.append(f"{entry.title}:\n {summaries[entry.chat_id]}")
+        parts = split_text(f"Summary for the past {hours} hours:\n\n" + "\n\n".join(sections))
+        await self.edit_message(sent_message, parts[0])
+        for part in parts[1:]:
+            await self.send_message(user_id, part)
+        logger.info(f"Sent digest of {len(entries)} chats to user {user_id}")
+
+    def open_session(self, user_id: int):
+        return self.session_pool.session(user_id, self.registry.get(user_id).phone)
+
+    async def get_chat_info(self, client: Client, user_id: int, chat_id: int):
+        info = self.chat_index.get(user_id, chat_id)
+        if info is None:
+            await self.telegram_limiter.acquire()
+            with span("get_chat", chat=chat_id):
+                chat = await client.get_chat(str(chat_id))
+            info = self.chat_index.put(user_id, chat)
+        return info
 
-    async def list(self, user_id: int):
-        if str(user_id) not in self.schedules:
+    async def resolve_chats(self, client: Client, user_id: int, chat_ids) -> dict:
+        chats = {}
+        missing = []
+        for chat_id in chat_ids:
+            info = self.chat_index.get(user_id, chat_id)
+            if info is None:
+                missing.append(chat_id)
+            else:
+                chats[chat_id] = info
+        if len(missing) > 1 and self.chat_index.user(user_id).refreshed_at is None:
+            # one dialog page resolves up to 100 chats, far cheaper than a get_chat for each
+            try:
+                await self.chat_index.refresh(user_id, client)
+            except Exception as e:
+                logger.warning(f"Could not list dialogs of user {user_id}: {e}")
+            entry = self.chat_index.user(user_id)
+            chats.update((i, entry.chats[i]) for i in missing if i in entry.chats)
+            missing = [i for i in missing if i not in chats]
+        semaphore = asyncio.Semaphore(RESOLVE_CONCURRENCY)
+
+        async def resolve(chat_id):
+            async with semaphore:
+                return await self.get_chat_info(client, user_id, chat_id)
+
+        results = await asyncio.gather(*[resolve(i) for i in missing], return_exceptions=True)
+        for chat_id, result in zip(missing, results):
+            if isinstance(result, Exception):
+                logger.warning(f"Could not resolve chat {chat_id} for user {user_id}: {result}")
+            else:
+                chats[chat_id] = result
+        return chats
+
+    async def list(self, user_id: int, query: str = "", page: int = 1):
+        if user_id not in self.registry:
             logger.warning(f"user_id {user_id} not found")
-            await self.app.send_message(user_id, "User information not found! Please use /register!")
+            await self.send_message(user_id, "User information not found! Please use /register!")
             return
+        if self.shards is not None:
+            return await self.shards.call(user_id, "list", query=query, page=page)
         sent_message = None
-        phone = self.schedules[str(user_id)][3]
-        session_name = phone.replace('+', '')
-        client = Client(
-            name=session_name,
-            api_id=self.api_id,
-            api_hash=self.api_hash,
-            phone_number=phone,
-            device_model="BOT",
-            system_version="Windows 10",
-            app_version="0.666",
-            workers=5,
-        )
-        async with client:
-            try:
-                sent_message = await self.app.send_message(user_id, "Please wait, this may take some time...\n")
-                result = await parse_chats(client, 40)
-                await self.app.edit_message_text(chat_id=sent_message.chat.id, message_id=sent_message.id,
-                                            text=f"{result}")
-                await client.stop()
-            except:
-                if sent_message is not None:
-                    await self.app.edit_message_text(chat_id=sent_message.chat.id, message_id=sent_message.id,
-                                            text=f"Unknown error while retrieving the chat list. Please try again later.\n ")
-                else:
-                    await self.app.send_message(chat_id=user_id,
-                                                 text=f"Unknown error while retrieving the chat list. Please try again later.\n ")
+        try:
+            if self.chat_index.user(user_id).refreshed_at is None:
+                sent_message = await self.send_message(user_id, "Please wait, this may take some time...\n")
+            await self.chat_index.ensure_fresh(user_id, partial(self.open_session, user_id))
+            chats, page, pages = self.chat_index.search(user_id, query, page)
+            if chats:
+                result = "\n".join(f"{i.title}: `{i.id}`" for i in chats)
+            else:
+                result = "No chats found."
+            if pages > 1:
+                result += f"\n\nPage {page} of {pages}. Use /list <page> or /list <search text> <page>."
+            if sent_message is not None:
+                await self.edit_message(sent_message, result)
+            else:
+                await self.send_message(user_id, result)
+        except Exception as e:
+            logger.error(f"Error in BotManager.list: {e}")
+            if sent_message is not None:
+                await self.edit_message(sent_message, f"Unknown error while retrieving the chat list. Please try again later.\n ")
+            else:
+                await self.send_message(user_id, f"Unknown error while retrieving the chat list. Please try again later.\n ")
 
 
     async def remove_info(self, user_id: int):
-        if str(user_id) not in self.schedules:
+        record = self.registry.get(user_id)
+        if record is None:
             logger.warning(f"user_id {user_id} not found")
-            await self.app.send_message(user_id, "User information not found! Please use /register!")
+            await self.send_message(user_id, "User information not found! Please use /register!")
             return
-        phone = self.schedules[str(user_id)][3]
-        session_name = phone.replace('+', '')
+        session_name = record.phone.replace('+', '')
+        if self.shards is not None:
+            await self.shards.call(user_id, "forget")
+        else:
+            await self.close_user(user_id)
         os.remove(f"{session_name}.session")
-        self.schedules.pop(str(user_id))
-        with open(self.json_file, 'w') as f:
-            json.dump(self.schedules, f, indent=2)
-        await self.app.send_message(user_id, f"Information deleted.")
+        self.scheduler.unschedule(user_id)
+        self.registry.remove(user_id)
+        await self.storage.delete_user(str(user_id))
+        await self.send_message(user_id, f"Information deleted.")
+
+    async def close_user(self, user_id: int):
+        if self.live is not None:
+            await self.live.unsubscribe(user_id)
+        await self.session_pool.close_session(user_id)
+        self.chat_index.forget(user_id)
+        if self.message_cache is not None:
+            await self.message_cache.forget_user(user_id)
 
     async def messages_now(self, user_id: int):
-        if str(user_id) not in self.schedules:
+        record = self.registry.get(user_id)
+        if record is None:
             logger.warning(f"user_id {user_id} not found")
-            await self.app.send_message(user_id, "User information not found! Please use /register!")
+            await self.send_message(user_id, "User information not found! Please use /register!")
             return
-        if len(self.schedules[str(user_id)][4]) < 1:
-            await self.app.send_message(user_id, "Chat information not found! Please use /add!")
+        if not record.chats:
+            await self.send_message(user_id, "Chat information not found! Please use /add!")
             return
         requested = await self.app.ask(user_id, "Please specify the number of hours for which to generate chat summaries.")
         try:
@@ -308,59 +888,125 @@ class BotManager:
             if hours > 48:
                 hours = 48
         except:
-            await self.app.send_message(user_id, "Invalid input format. Please try again later.")
+            await self.send_message(user_id, "Invalid input format. Please try again later.")
+            return
+        with span("now", user=user_id, hours=hours):
+            await self.summarise_chats(user_id, hours)
+
+    async def summarise_chats(self, user_id: int, hours: int):
+        if not self.accepting:
+            await self.send_message(user_id, "The bot is restarting, please try again in a minute.")
             return
-        client = None
         try:
-            last_called = (datetime.now(timezone.utc) - timedelta(minutes=3)).isoformat()
-            self.schedules[str(user_id)][2] = last_called
-            with open(self.json_file, 'w') as f:
-                json.dump(self.schedules, f, indent=2)
-            phone = self.schedules[str(user_id)][3]
-            summary_list = self.schedules[str(user_id)][4]
-            session_name = phone.replace('+', '')
-            client = Client(
-                name=session_name,
-                api_id=self.api_id,
-                api_hash=self.api_hash,
-                phone_number=phone,
-                device_model="BOT",
-                system_version="Windows 10",
-                app_version="0.666",
-                workers=5,
-            )
-            async with client:
-                logger.info("Starting client")
-                async with asyncio.TaskGroup() as tg:
-                    logger.info("Starting TaskGroup")
-                    for chat_id in summary_list:
-                        logger.info("Starting Adding task")
-                        tg.create_task(self.summarise_chat_with_limit(chat_id=chat_id,
-                                                           last_time=datetime.now(timezone.utc) - timedelta(hours=hours, minutes=5),
-                                                           client=client, user_id=user_id))
-                logger.info("Stoppping client")
-            logger.info(f"Executed messages_now for chat {user_id}")
-        except ExceptionGroup as e:
-            for exc in e.exceptions:
-                logger.error(f"Error in group: {exc}")
+            record = self.registry.get(user_id)
+            record.last_called = (datetime.now(timezone.utc) - timedelta(minutes=3)).isoformat()
+            await self.save_user(record)
+            if self.shards is not None:
+                await self.shards.call(user_id, "summarise", hours=hours)
+            else:
+                await self.summarise_user_chats(user_id, hours)
         except Exception as e:
             logger.error(f"Error - {e}")
-            await self.app.send_message(user_id, "Unknown error. Please try again later")
-    async def summarise_chat_with_limit(self, chat_id, last_time, client: Client, user_id: int):
-        async with self.semaphore:
+            if self.accepting:
+                await self.send_message(user_id, "Unknown error. Please try again later", status=True)
+
+    def chat_done(self, pending: PendingSummary, chat_id: int, future: asyncio.Future):
+        # cancelled chats and undelivered digest entries stay pending for the checkpoint
+        if future.cancelled():
+            return
+        if future.exception() is None and isinstance(future.result(), DigestEntry):
+            return
+        if chat_id in pending.chats:
+            pending.chats.remove(chat_id)
+
+    async def summarise_user_chats(self, user_id: int, hours: int, since: datetime = None, chats: list = None):
+        summary_list = list(self.registry.get(user_id).chats if chats is None else chats)
+        last_time = since or datetime.now(timezone.utc) - timedelta(hours=hours, minutes=5)
+        pending = PendingSummary(user_id, hours, last_time, list(summary_list), asyncio.current_task())
+        self.inflight.add(pending)
+        try:
+            await self.run_summaries(pending, summary_list)
+        finally:
+            self.inflight.discard(pending)
+
+    async def run_summaries(self, pending: PendingSummary, summary_list: list):
+        user_id, hours, last_time = pending.user_id, pending.hours, pending.since
+        missing = [i for i in summary_list if self.chat_index.user(user_id).chats.get(i) is None]
+        if missing:
+            # resolve every title in one go instead of one get_chat at the start of each job
+            try:
+                async with self.open_session(user_id) as client:
+                    await self.resolve_chats(client, user_id, missing)
+            except Exception as e:
+                logger.warning(f"Could not resolve chats of user {user_id} up front: {e}")
+        futures = []
+        positions = []
+        collect_small = self.digest and len(summary_list) > 1
+        for chat_id in summary_list:
+            future, position = await self.work_queue.submit(
+                user_id, partial(self.summarise_chat_job, chat_id, last_time, user_id, collect_small),
+                name=f"summary of {chat_id}")
+            future.add_done_callback(partial(self.chat_done, pending, chat_id))
+            futures.append(future)
+            positions.append(position)
+        if positions and positions[0] > self.work_queue.workers - self.work_queue.running:
+            await self.send_message(user_id, f"Your request is queued at position {positions[0]}, summaries will follow shortly.",
+                                    status=True)
+        results = await asyncio.gather(*futures, return_exceptions=True)
+        for chat_id, result in zip(summary_list, results):
+            if isinstance(result, Exception):
+                logger.error(f"Error summarising chat {chat_id} for user {user_id}: {result}")
+        entries = [i for i in results if isinstance(i, DigestEntry)]
+        if entries:
+            await self.deliver_digest(user_id, hours, entries)
+        logger.info(f"Summarised chats for user {user_id}")
+
+    async def summarise_chat_job(self, chat_id, last_time, user_id: int, collect_small: bool = False):
+        record = self.registry.get(user_id)
+        if record is None:
+            logger.warning(f"User {user_id} removed before summary of chat {chat_id} started")
+            return
+        reader = user_id
+        # users only get buffered or shared history of chats their own session has recently shown them
+        if self.chat_index.confirmed(user_id, chat_id):
+            lines = await self.stored_lines(chat_id, last_time, user_id)
+            if lines is not None:
+                # everything needed is buffered or cached, no session or history calls required
+                return await self.summarise_chat(chat_id, last_time, None, user_id, collect_small,
+                                                 join_lines(lines, self.max_transcript_chars))
+            if self.is_shared(chat_id):
+                reader = self.warm_subscriber(chat_id, user_id)
+
+        async def attempt():
+            if reader == user_id and not self.chat_index.confirmed(user_id, chat_id):
+                # one get_chat renews access, so the next requests can be served from the buffer or cache again
+                await self.confirm_chat(client, user_id, chat_id)
+            return await self.summarise_chat(chat_id, last_time, client, user_id, collect_small)
+
+        async with self.open_session(reader) as client:
             try:
-                await self.summarise_chat(chat_id, last_time, client, user_id)
+                return await attempt()
+            except FloodWait as e:
+                FLOOD_WAITS.inc(api="telegram")
+                logger.warning(f"FloodWait of {e.value}s summarising chat {chat_id}, retrying")
+                self.telegram_limiter.penalise(e.value)
+                return await attempt()
             except Exception as e:
                 logger.error(f"Error on attempt 1 summarising chat- {e}")
-                await self.app.send_message(user_id, "Unknown error, retrying...")
+                await self.send_message(user_id, "Unknown error, retrying...", status=True)
                 try:
-                    await self.summarise_chat(chat_id, last_time, client, user_id)
+                    return await attempt()
                 except Exception as e:
                     logger.error(f"Error on attempt 2 summarising chat- {e}")
-                    await self.app.send_message(user_id, "Unknown error, please try again!")
+                    await self.send_message(user_id, "Unknown error, please try again!", status=True)
                     raise e
+    async def send_message(self, chat_id, text, status: bool = False):
+        # queued in the outbox, the returned message can be edited right away and gets its id once sent
+        return self.outbox.send(chat_id, text, status)
+    async def edit_message(self, message, text):
+        return self.outbox.edit(message, text)
     async def check_user_presence(self, user_id: int):
-        if str(user_id) not in self.schedules:
+        if user_id not in self.registry:
             logger.info(f"user_id {user_id} not found")
             return 0
         else:
@@ -369,39 +1015,78 @@ class BotManager:
 
     async def list_all_current_chats(self, user_id: int):
         try:
-            if str(user_id) not in self.schedules:
+            record = self.registry.get(user_id)
+            if record is None:
                 logger.info(f"User {user_id} not found.")
-                await self.app.send_message(user_id, "User not found. Please register first by using the /register command.")
+                await self.send_message(user_id, "User not found. Please register first by using the /register command.")
                 return
-            item = self.schedules[str(user_id)]
+            if self.shards is not None:
+                return await self.shards.call(user_id, "list_current")
             result = []
-            phone = item[3]
-            session_name = phone.replace('+', '')
-            client = Client(
-                name=session_name,
-                api_id=self.api_id,
-                api_hash=self.api_hash,
-                phone_number=phone,
-                device_model="BOT",
-                system_version="Windows 10",
-                app_version="0.666",
-                workers=1,
-            )
-            async with client:
-                logger.info("Starting client")
-                for i in item[4]:
-                    chat = await client.get_chat(str(i))
-                    result.append(f"{chat.title}: `{i}`")
-            logger.info("Stopping client")
-            await self.app.send_message(user_id, "\n".join(result))
+            async with self.session_pool.session(user_id, record.phone) as client:
+                logger.info("Acquired client")
+                chat_ids = sorted(record.chats)
+                chats = await self.resolve_chats(client, user_id, chat_ids)
+                for i in chat_ids:
+                    chat = chats.get(i)
+                    result.append(f"{chat.title}: `{i}`" if chat is not None else f"Unavailable chat: `{i}`")
+            logger.info("Released client")
+            await self.send_message(user_id, "\n".join(result))
         except Exception as e:
             logger.error(f"Error in list_all_current_chat: {e}")
             raise e
 
+    async def drain(self):
+        deadline = time.monotonic() + self.shutdown_timeout
+        while self.inflight and time.monotonic() < deadline:
+            await asyncio.sleep(0.2)
+
+    async def checkpoint(self):
+        jobs = [i.checkpoint() for i in self.inflight if i.chats]
+        if self.jobs_file is not None and jobs:
+            await asyncio.to_thread(write_json_atomic, self.jobs_file, json.dumps(jobs))
+            logger.info(f"Checkpointed {len(jobs)} unfinished summaries to {self.jobs_file}")
+        for pending in list(self.inflight):
+            if pending.chats and self.jobs_file is not None:
+                try:
+                    await self.send_message(pending.user_id, "The bot is restarting, your summary will continue automatically afterwards.",
+                                            status=True)
+                except Exception as e:
+                    logger.warning(f"Could not notify user {pending.user_id} about the restart: {e}")
+            pending.task.cancel()
+
     async def shutdown(self):
         logger.info(f"Shutting down...")
-        for i in self.running_tasks.values():
+        # stop taking new work, let running summaries finish and save whatever misses the deadline
+        self.accepting = False
+        await self.scheduler.stop()
+        if self.shards is not None:
+            await self.shards.close()
+        await self.drain()
+        # jobs still running are cancelled first, so nothing written to the checkpoint is also delivered now
+        await self.work_queue.stop()
+        await self.checkpoint()
+        # restart notices and finished summaries still go out before the bot client stops
+        await self.outbox.close(self.shutdown_timeout)
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+        tasks = list(self.running_tasks.values())
+        for i in tasks:
+            i.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for i in list(self.background_tasks):
             i.cancel()
-            await i
+        await asyncio.gather(*self.background_tasks, return_exceptions=True)
+        if self.live is not None:
+            await self.live.close()
+        await self.session_pool.close()
+        await self.llm.close()
+        if self.enricher is not None:
+            await self.enricher.close()
+        if self.message_cache is not None:
+            self.message_cache.close()
+        self.storage.close()
+        if self.summary_cache is not None:
+            self.summary_cache.close()
         return
 
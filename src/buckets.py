@@ -0,0 +1,57 @@
+import bisect
+from datetime import datetime, timezone
+
+from src.chunking import split_messages
+
+# each level covers this many buckets of the level below
+FANOUT = 4
+LEVELS = 3
+
+
+class TimedMessages:
+    def __init__(self, text: str):
+        self.times = []
+        self.messages = []
+        last = 0.0
+        for message in split_messages(text):
+            # messages are formatted as "[<timestamp>] sender: text", continuation lines keep the previous time
+            last = message_time(message) or last
+            self.times.append(last)
+            self.messages.append(message)
+
+    def between(self, start: float, end: float) -> str:
+        return "\n".join(self.messages[bisect.bisect_left(self.times, start):bisect.bisect_left(self.times, end)])
+
+
+def message_time(message: str) -> float | None:
+    end = message.find("] ")
+    if not message.startswith("[") or end < 0:
+        return None
+    try:
+        return datetime.fromisoformat(message[1:end]).timestamp()
+    except ValueError:
+        return None
+
+
+def plan_window(since: float, now: float, bucket: float) -> tuple:
+    # closed buckets are covered by the largest aligned blocks that fit, so the same blocks recur across requests
+    first = int(-(-since // bucket) * bucket)
+    closed_end = int(now // bucket * bucket)
+    blocks = []
+    position = first
+    while position < closed_end:
+        span = bucket * FANOUT ** (LEVELS - 1)
+        while position % span or position + span > closed_end:
+            span //= FANOUT
+        blocks.append((position, span))
+        position += span
+    if first >= closed_end:
+        # window shorter than one bucket, nothing to reuse
+        return (since, now), [], None
+    return (since, first), blocks, (closed_end, now)
+
+
+def block_label(start: float, end: float) -> str:
+    start = datetime.fromtimestamp(start, timezone.utc)
+    end = datetime.fromtimestamp(end, timezone.utc)
+    return f"[{start:%Y-%m-%d %H:%M} - {end:%H:%M} UTC]"
@@ -0,0 +1,145 @@
+import asyncio
+import logging
+import time
+
+from pyrogram import enums
+from pyrogram.errors import FloodWait
+
+from src.metrics import CACHE_REQUESTS, FLOOD_WAITS, span
+from src.rate_limit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+
+def chat_title(chat) -> str:
+    if chat.type == enums.ChatType.PRIVATE:
+        name = f"{'Deleted Account' if chat.first_name is None else chat.first_name}"
+        if chat.last_name:
+            name += f" {chat.last_name}"
+        return name
+    return chat.title or "Unnamed Chat"
+
+
+class ChatInfo:
+    __slots__ = ("id", "title", "type", "last_message_id", "checked_at")
+
+    def __init__(self, chat_id: int, title: str, chat_type, last_message_id: int = None):
+        self.id = chat_id
+        self.title = title
+        self.type = chat_type
+        self.last_message_id = last_message_id
+        # when the user's own session last showed this chat
+        self.checked_at = time.monotonic()
+
+
+class UserChats:
+    def __init__(self):
+        self.chats: dict[int, ChatInfo] = {}
+        self.order = []
+        self.refreshed_at = None
+        self.refreshing = None
+
+
+class ChatIndex:
+    def __init__(self, limiter: TokenBucket, ttl: float = 3600.0, max_dialogs: int = 1000):
+        self.limiter = limiter
+        self.ttl = ttl
+        self.max_dialogs = max_dialogs
+        self.users: dict[int, UserChats] = {}
+
+    def user(self, user_id: int) -> UserChats:
+        entry = self.users.get(user_id)
+        if entry is None:
+            entry = self.users[user_id] = UserChats()
+        return entry
+
+    def forget(self, user_id: int):
+        self.users.pop(user_id, None)
+
+    def put(self, user_id: int, chat) -> ChatInfo:
+        entry = self.user(user_id)
+        info = entry.chats.get(chat.id)
+        if info is None:
+            info = entry.chats[chat.id] = ChatInfo(chat.id, chat_title(chat), chat.type)
+        else:
+            info.title = chat_title(chat)
+            info.type = chat.type
+            info.checked_at = time.monotonic()
+        return info
+
+    def get(self, user_id: int, chat_id: int) -> ChatInfo | None:
+        entry = self.users.get(user_id)
+        info = entry.chats.get(chat_id) if entry is not None else None
+        CACHE_REQUESTS.inc(cache="chats", result="hit" if info is not None else "miss")
+        return info
+
+    def confirmed(self, user_id: int, chat_id: int) -> bool:
+        # the user's session showed this chat within the ttl, so they can still read it
+        entry = self.users.get(user_id)
+        info = entry.chats.get(chat_id) if entry is not None else None
+        return info is not None and time.monotonic() - info.checked_at <= self.ttl
+
+    async def refresh(self, user_id: int, client):
+        entry = self.user(user_id)
+        chats = {}
+        order = []
+        count = 0
+        started = time.monotonic()
+        with span("refresh_dialogs", user=user_id):
+            while True:
+                try:
+                    async for dialog in client.get_dialogs():
+                        # get_dialogs pulls pages of 100, account for each page request
+                        if count % 100 == 0:
+                            await self.limiter.acquire()
+                        count += 1
+                        if count > self.max_dialogs:
+                            break
+                        info = ChatInfo(dialog.chat.id, chat_title(dialog.chat), dialog.chat.type,
+                                        dialog.top_message.id if dialog.top_message else None)
+                        chats[info.id] = info
+                        order.append(info.id)
+                    break
+                except FloodWait as e:
+                    FLOOD_WAITS.inc(api="telegram")
+                    logger.warning(f"FloodWait of {e.value}s listing dialogs for user {user_id}")
+                    self.limiter.penalise(e.value)
+                    chats, order, count = {}, [], 0
+        # a complete dialog list drops chats the user left, a truncated one keeps chats resolved
+        # individually within the ttl since they may just be past the limit
+        now = time.monotonic()
+        for chat_id, info in entry.chats.items():
+            if info.checked_at >= started or (count > self.max_dialogs and now - info.checked_at <= self.ttl):
+                chats.setdefault(chat_id, info)
+        entry.chats = chats
+        entry.order = order
+        entry.refreshed_at = time.monotonic()
+        logger.info(f"Indexed {len(order)} dialogs for user {user_id}")
+
+    async def refresh_in_session(self, user_id: int, open_session):
+        async with open_session() as client:
+            await self.refresh(user_id, client)
+
+    def refresh_done(self, entry: UserChats, task: asyncio.Task):
+        entry.refreshing = None
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Error refreshing chat index: {task.exception()}")
+
+    async def ensure_fresh(self, user_id: int, open_session, wait: bool = False):
+        # stale entries are served immediately and refreshed in the background, only a cold index blocks
+        entry = self.user(user_id)
+        stale = entry.refreshed_at is None or time.monotonic() - entry.refreshed_at > self.ttl
+        if entry.refreshing is None and stale:
+            entry.refreshing = asyncio.create_task(self.refresh_in_session(user_id, open_session))
+            entry.refreshing.add_done_callback(lambda task: self.refresh_done(entry, task))
+        if entry.refreshing is not None and (wait or entry.refreshed_at is None):
+            await asyncio.shield(entry.refreshing)
+
+    def search(self, user_id: int, query: str = "", page: int = 1, page_size: int = 40) -> tuple:
+        entry = self.user(user_id)
+        query = query.casefold()
+        matches = [entry.chats[i] for i in entry.order
+                   if not query or query in entry.chats[i].title.casefold() or query in str(i)]
+        pages = max(1, -(-len(matches) // page_size))
+        page = min(max(page, 1), pages)
+        return matches[(page - 1) * page_size:page * page_size], page, pages
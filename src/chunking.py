@@ -0,0 +1,82 @@
+import logging
+import re
+import zlib
+from functools import lru_cache
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+# every formatted message starts with "[<timestamp>] ", see format_message
+MESSAGE_START = re.compile(r"\n(?=\[\d{4}-\d{2}-\d{2} )")
+BOUNDARY_MODULUS = 16
+
+
+class TokenCounter:
+    def __init__(self, model: str):
+        self.encoding = None
+        if tiktoken is None:
+            return
+        try:
+            self.encoding = tiktoken.encoding_for_model(model)
+        except KeyError:
+            try:
+                self.encoding = tiktoken.get_encoding("o200k_base")
+            except Exception as e:
+                logger.warning(f"Falling back to approximate token counts: {e}")
+        except Exception as e:
+            logger.warning(f"Falling back to approximate token counts: {e}")
+
+    def count(self, text: str) -> int:
+        if self.encoding is not None:
+            return len(self.encoding.encode(text, disallowed_special=()))
+        # conservative estimate, non-latin scripts average well under 4 chars per token
+        return len(text) // 3 + 1
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        if self.encoding is not None:
+            return self.encoding.decode(self.encoding.encode(text, disallowed_special=())[:max_tokens])
+        return text[:max_tokens * 3]
+
+
+@lru_cache(maxsize=None)
+def get_token_counter(model: str) -> TokenCounter:
+    return TokenCounter(model)
+
+
+def split_messages(text: str) -> list:
+    return MESSAGE_START.split(text)
+
+
+def is_boundary(message: str) -> bool:
+    return zlib.crc32(message.encode()) % BOUNDARY_MODULUS == 0
+
+
+def chunk_messages(messages: list, counter: TokenCounter, max_tokens: int) -> list:
+    # Boundaries are content-defined: past half the budget a chunk is closed after any message whose hash
+    # hits the modulus. Overlapping windows therefore re-synchronise on the same chunks and reuse cached
+    # summaries instead of shifting every boundary by the window offset.
+    chunks = []
+    current = []
+    current_tokens = 0
+    for message in messages:
+        tokens = counter.count(message) + 1
+        if tokens > max_tokens:
+            message = counter.truncate(message, max_tokens - 1)
+            tokens = max_tokens
+        if current and current_tokens + tokens > max_tokens:
+            chunks.append("\n".join(current))
+            current = []
+            current_tokens = 0
+        current.append(message)
+        current_tokens += tokens
+        if current_tokens >= max_tokens // 2 and is_boundary(message):
+            chunks.append("\n".join(current))
+            current = []
+            current_tokens = 0
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
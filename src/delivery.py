@@ -0,0 +1,66 @@
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_LIMIT = 4096
+
+
+def split_text(text: str, limit: int = MESSAGE_LIMIT) -> list:
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut < limit // 2:
+            cut = text.rfind(" ", 0, limit)
+        if cut < limit // 2:
+            cut = limit
+        parts.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+    parts.append(text)
+    return parts
+
+
+class ProgressiveMessage:
+    def __init__(self, manager, user_id: int, message, header: str, interval: float = 2.0):
+        self.manager = manager
+        self.user_id = user_id
+        self.messages = [message]
+        self.rendered = [message.text or ""]
+        self.header = header
+        self.interval = interval
+        self.text = ""
+        self.last_flush = 0.0
+        self.flushing = None
+
+    def update(self, text: str):
+        # coalesce: only the newest text is rendered, at most once per interval
+        self.text = text
+        if self.flushing is None and time.monotonic() - self.last_flush >= self.interval:
+            self.flushing = asyncio.create_task(self.flush(final=False))
+
+    async def flush(self, final: bool):
+        try:
+            parts = split_text(f"{self.header}{self.text}" + ("\n\n " if final else " ..."))
+            for i, part in enumerate(parts):
+                if i < len(self.messages):
+                    if self.rendered[i] != part:
+                        # the outbox merges this with an edit of the same message that hasn't gone out yet
+                        await self.manager.edit_message(self.messages[i], part)
+                else:
+                    self.messages.append(await self.manager.send_message(self.user_id, part))
+                self.rendered[i:i + 1] = [part]
+        except Exception as e:
+            if final:
+                raise e
+            logger.warning(f"Skipping progressive update for user {self.user_id}: {e}")
+        finally:
+            self.last_flush = time.monotonic()
+            if not final:
+                self.flushing = None
+
+    async def finish(self, text: str):
+        if self.flushing is not None:
+            await self.flushing
+        self.text = text
+        await self.flush(final=True)
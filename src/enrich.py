@@ -0,0 +1,187 @@
+import asyncio
+import importlib.util
+import io
+import logging
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+
+from src.metrics import ENRICHED_MEDIA, STAGE_SECONDS
+from src.summary_cache import SummaryCache
+
+logger = logging.getLogger(__name__)
+
+TEXT_EXTENSIONS = (".txt", ".md", ".csv", ".json", ".log", ".py", ".html", ".xml", ".yaml", ".yml")
+
+
+def installed(*modules: str) -> bool:
+    # the extractor packages are heavy, only check they exist until a file actually needs them
+    return all(importlib.util.find_spec(i) is not None for i in modules)
+
+
+class Extractor(ABC):
+    name = ""
+    kinds = ()
+    label = ""
+
+    def accepts(self, kind: str, media) -> bool:
+        return kind in self.kinds
+
+    @abstractmethod
+    def extract(self, data: io.BytesIO, media) -> str:
+        ...
+
+
+class SpeechExtractor(Extractor):
+    name = "speech"
+    kinds = ("voice", "audio", "video_note")
+    label = "transcript"
+
+    def __init__(self, model: str = "base"):
+        self.model_name = model
+        self.model = None
+
+    def extract(self, data: io.BytesIO, media) -> str:
+        if self.model is None:
+            # loading takes seconds, only pay for it once the first voice message shows up
+            from faster_whisper import WhisperModel
+            self.model = WhisperModel(self.model_name, device="cpu", compute_type="int8")
+        segments, _ = self.model.transcribe(data)
+        return " ".join(i.text.strip() for i in segments)
+
+
+class OcrExtractor(Extractor):
+    name = "ocr"
+    kinds = ("photo",)
+    label = "text in image"
+
+    def extract(self, data: io.BytesIO, media) -> str:
+        import pytesseract
+        from PIL import Image
+        return " ".join(pytesseract.image_to_string(Image.open(data)).split())
+
+
+class DocumentExtractor(Extractor):
+    name = "documents"
+    kinds = ("document",)
+    label = "document"
+
+    def __init__(self, max_chars: int = 2000):
+        self.max_chars = max_chars
+        self.pdf = installed("pypdf")
+
+    def accepts(self, kind: str, media) -> bool:
+        name = (media.file_name or "").lower()
+        return kind in self.kinds and (name.endswith(TEXT_EXTENSIONS) or (self.pdf and name.endswith(".pdf")))
+
+    def extract(self, data: io.BytesIO, media) -> str:
+        if (media.file_name or "").lower().endswith(".pdf"):
+            from pypdf import PdfReader
+            text = ""
+            for page in PdfReader(data).pages:
+                text += page.extract_text() or ""
+                if len(text) > self.max_chars:
+                    break
+        else:
+            text = data.read(self.max_chars * 4).decode("utf-8", errors="replace")
+        return " ".join(text.split())[:self.max_chars]
+
+
+def create_extractors(names, whisper_model: str = "base") -> list:
+    extractors = []
+    for name in names:
+        if name == "speech" and installed("faster_whisper"):
+            extractors.append(SpeechExtractor(whisper_model))
+        elif name == "ocr" and installed("pytesseract", "PIL"):
+            extractors.append(OcrExtractor())
+        elif name == "documents":
+            extractors.append(DocumentExtractor())
+        else:
+            logger.warning(f"Media extractor {name} is unknown or its packages are not installed, skipping it")
+    return extractors
+
+
+class Enricher:
+    def __init__(self, extractors: list, cache: SummaryCache, workers: int = 2, max_file_size: int = 20 * 2 ** 20,
+                 timeout: float = 20.0, max_files: int = 30):
+        self.extractors = extractors
+        self.cache = cache
+        self.max_file_size = max_file_size
+        self.timeout = timeout
+        self.max_files = max_files
+        self.downloads = asyncio.Semaphore(workers)
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="enrich")
+        self.tasks = set()
+
+    def extractor_for(self, message):
+        for kind in ("voice", "audio", "video_note", "photo", "document"):
+            media = getattr(message, kind, None)
+            if media is None:
+                continue
+            if (media.file_size or 0) > self.max_file_size:
+                return None, None
+            for extractor in self.extractors:
+                if extractor.accepts(kind, media):
+                    return extractor, media
+            return None, None
+        return None, None
+
+    def wants(self, message) -> bool:
+        return self.extractor_for(message)[0] is not None
+
+    async def describe(self, client, message, extractor: Extractor, media, downloaded: asyncio.Event) -> str:
+        async def compute():
+            async with self.downloads:
+                with STAGE_SECONDS.time(stage=f"enrich_{extractor.name}"):
+                    data = await client.download_media(message, in_memory=True)
+                    downloaded.set()
+                    data.seek(0)
+                    try:
+                        text = await asyncio.get_running_loop().run_in_executor(self.pool, extractor.extract, data,
+                                                                                 media)
+                    except Exception as e:
+                        logger.warning(f"{extractor.name} extraction failed for {media.file_unique_id}: {e}")
+                        text = ""
+            ENRICHED_MEDIA.inc(extractor=extractor.name)
+            return text
+
+        # file_unique_id is the same for every user and forward of a file, so each is processed once
+        return await self.cache.get_or_compute(f"{extractor.name}:{media.file_unique_id}", compute)
+
+    async def enrich(self, client, messages: list) -> tuple[dict, set]:
+        # returns {message_id: "(label: text)"} for whatever finished within the time budget,
+        # and the ids of messages whose media is still being processed
+        started = {}
+        for message in messages[:self.max_files]:
+            extractor, media = self.extractor_for(message)
+            downloaded = asyncio.Event()
+            task = asyncio.create_task(self.describe(client, message, extractor, media, downloaded))
+            self.tasks.add(task)
+            task.add_done_callback(self.finished)
+            started[task] = (message.id, extractor.label, downloaded)
+        if not started:
+            return {}, set()
+        done, pending = await asyncio.wait(started, timeout=self.timeout)
+        # the client goes back to the session pool once the caller returns, so unfinished downloads stop here,
+        # files already downloaded keep being processed and fill the cache for the next summary
+        downloading = [task for task in pending if not started[task][2].is_set()]
+        for task in downloading:
+            task.cancel()
+        await asyncio.gather(*downloading, return_exceptions=True)
+        results = {}
+        for task in done:
+            if not task.cancelled() and task.exception() is None and task.result():
+                message_id, label, _ = started[task]
+                results[message_id] = f"({label}: {task.result()})"
+        return results, {started[task][0] for task in pending}
+
+    def finished(self, task: asyncio.Task):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(f"Media enrichment failed: {task.exception()}")
+
+    async def close(self):
+        for task in list(self.tasks):
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.pool.shutdown(wait=False, cancel_futures=True)
+        self.cache.close()
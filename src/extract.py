@@ -0,0 +1,100 @@
+import hashlib
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class MessageRecord:
+    __slots__ = ("message_id", "date", "sender", "text", "media")
+
+    def __init__(self, message_id: int, date, sender: str, text: str, media: tuple):
+        self.message_id = message_id
+        self.date = date
+        self.sender = sender
+        self.text = text
+        self.media = media
+
+    def line(self) -> str:
+        text = self.text
+        if self.media:
+            text += f" {' '.join(self.media)}"
+        return f"[{self.date}] {self.sender}: {text}"
+
+
+def media_tags(message) -> tuple:
+    media_info = []
+
+    if message.audio:
+        media_info.append("[AUDIO]")
+    if message.voice:
+        media_info.append("[VOICE]")
+    if message.video:
+        media_info.append("[VIDEO]")
+    if message.photo:
+        media_info.append("[PHOTO]")
+    if message.document:
+        media_info.append(f"[FILE: {message.document.file_name}]")
+    if message.sticker:
+        media_info.append("[STICKER]")
+    if message.animation:
+        media_info.append("[GIF]")
+    if message.video_note:
+        media_info.append("[VIDEO NOTE]")
+
+    return tuple(media_info)
+
+
+def media_unique_id(message) -> str | None:
+    for kind in ("audio", "voice", "video", "photo", "document", "sticker", "animation", "video_note"):
+        media = getattr(message, kind)
+        if media is not None:
+            return media.file_unique_id
+    return None
+
+
+class MessageFilter:
+    def __init__(self, skip_bots: bool = True, max_forwards: int = 4096):
+        self.skip_bots = skip_bots
+        self.max_forwards = max_forwards
+        self.forwards = OrderedDict()
+
+    def forward_key(self, message):
+        if message.forward_from_chat is not None and message.forward_from_message_id:
+            return (message.forward_from_chat.id, message.forward_from_message_id)
+        if message.forward_date is None:
+            return None
+        # forwards from users carry no message id, the original author and date identify the message
+        origin = message.forward_from.id if message.forward_from is not None else message.forward_sender_name
+        content = media_unique_id(message)
+        if content is None:
+            text = message.text or message.caption or ""
+            if not text.strip():
+                return None
+            content = hashlib.blake2b(text.encode(), digest_size=8).digest()
+        return (origin, message.forward_date, content)
+
+    def accept(self, message) -> bool:
+        if message.empty or message.service:
+            return False
+        if self.skip_bots and message.from_user is not None and message.from_user.is_bot:
+            return False
+        key = self.forward_key(message)
+        if key is not None:
+            if key in self.forwards:
+                return False
+            self.forwards[key] = None
+            if len(self.forwards) > self.max_forwards:
+                self.forwards.popitem(last=False)
+        return True
+
+
+def extract_record(message, message_filter: MessageFilter = None) -> MessageRecord | None:
+    if message_filter is not None and not message_filter.accept(message):
+        return None
+    sender = message.from_user.first_name if message.from_user else "Unknown"
+    text = message.text or message.caption or ""
+    media = media_tags(message)
+    if not text.strip() and not media:
+        return None
+    return MessageRecord(message.id, message.date, sender, str(text), media)
@@ -3,6 +3,8 @@ import asyncio
 import logging
 from pyrogram import filters
 
+from src.metrics import start_trace
+
 logger = logging.getLogger(__name__)
 
 def register_handlers(app, manager, authorized_users):
@@ -11,22 +13,25 @@ def register_handlers(app, manager, authorized_users):
         chat_id = message.chat.id
         user_id = message.from_user.id
         logger.info(f"Received /register command from user {user_id}.")
+        # the bot answers before BotManager.start has loaded the registry
+        await manager.started.wait()
         if user_id not in authorized_users:
-            await app.send_message(chat_id, "You are not authorized to use this command.")
+            await manager.send_message(chat_id, "You are not authorized to use this command.")
             return
         try:
             await manager.add_user(user_id=user_id, hours=None)
         except Exception as e:
             logger.error(f"Error in /register command for user {user_id}: {e}")
-            await app.send_message(chat_id, "Unexpected error. Please try again later.")
+            await manager.send_message(chat_id, "Unexpected error. Please try again later.")
 
     @app.on_message(filters.command("add"))
     async def add_command(client, message):
         chat_id = message.chat.id
         user_id = message.from_user.id
         logger.info(f"Received /add command from user {user_id}.")
+        await manager.started.wait()
         if user_id not in authorized_users:
-            await app.send_message(chat_id, "You are not authorized to use this command.")
+            await manager.send_message(chat_id, "You are not authorized to use this command.")
             return
         try:
             if await manager.check_user_presence(user_id):
@@ -35,21 +40,22 @@ def register_handlers(app, manager, authorized_users):
                     "Please specify the chat number to be summarized, one per message"
                 )
                 await manager.add_chat_for_user(user_id=user_id, chat_id=int(response_message.text))
-                await app.send_message(chat_id, "Added.")
+                await manager.send_message(chat_id, "Added.")
             else:
                 logger.warning(f"user_id {user_id} not found")
-                await app.send_message(user_id, "User information not found! Please use /register!")
+                await manager.send_message(user_id, "User information not found! Please use /register!")
         except Exception as e:
             logger.error(f"Error in /add command for user {user_id}: {e}")
-            await app.send_message(chat_id, "Unexpected error. Please try again later.")
+            await manager.send_message(chat_id, "Unexpected error. Please try again later.")
 
     @app.on_message(filters.command("delete"))
     async def delete_command(client, message):
         chat_id = message.chat.id
         user_id = message.from_user.id
         logger.info(f"Received /delete command from user {user_id}.")
+        await manager.started.wait()
         if user_id not in authorized_users:
-            await app.send_message(chat_id, "You are not authorized to use this command.")
+            await manager.send_message(chat_id, "You are not authorized to use this command.")
             return
         try:
             if await manager.check_user_presence(user_id):
@@ -58,22 +64,52 @@ def register_handlers(app, manager, authorized_users):
                     "Please specify the chat number to be deleted, one per message"
                 )
                 await manager.remove_chat_for_user(user_id=user_id, chat_id=int(response_message.text))
-                await app.send_message(chat_id, "Deleted.")
+                await manager.send_message(chat_id, "Deleted.")
             else:
                 logger.warning(f"user_id {user_id} not found")
-                await app.send_message(user_id, "User information not found! Please use /register!")
+                await manager.send_message(user_id, "User information not found! Please use /register!")
         except Exception as e:
             logger.error(f"Error in /delete command for user {user_id}: {e}")
-            await app.send_message(chat_id, "Unexpected error. Please try again later.")
+            await manager.send_message(chat_id, "Unexpected error. Please try again later.")
+
+    @app.on_message(filters.command("schedule"))
+    async def schedule_command(client, message):
+        chat_id = message.chat.id
+        user_id = message.from_user.id
+        logger.info(f"Received /schedule command from user {user_id}.")
+        await manager.started.wait()
+        if user_id not in authorized_users:
+            await manager.send_message(chat_id, "You are not authorized to use this command.")
+            return
+        try:
+            if await manager.check_user_presence(user_id):
+                response_message = await app.ask(
+                    user_id,
+                    "Please specify how often, in hours, to send automatic summaries (0 to disable)"
+                )
+                hours = int(response_message.text)
+                if hours < 0:
+                    raise ValueError(f"negative interval {hours}")
+                await manager.set_schedule(user_id=user_id, hours=hours)
+                await manager.send_message(chat_id, f"Automatic summaries every {hours} hours." if hours else "Automatic summaries disabled.")
+            else:
+                logger.warning(f"user_id {user_id} not found")
+                await manager.send_message(user_id, "User information not found! Please use /register!")
+        except Exception as e:
+            logger.error(f"Error in /schedule command for user {user_id}: {e}")
+            await manager.send_message(chat_id, "Unexpected error. Please try again later.")
 
     @app.on_message(filters.command("now"))
     async def now_command(client, message):
         chat_id = message.chat.id
         user_id = message.from_user.id
         logger.info(f"Received /now command from user {user_id}.")
+        await manager.started.wait()
         if user_id not in authorized_users:
-            await app.send_message(chat_id, "You are not authorized to use this command.")
+            await manager.send_message(chat_id, "You are not authorized to use this command.")
             return
+        trace_id = start_trace()
+        logger.debug(f"trace={trace_id} started for /now from user {user_id}")
         asyncio.create_task(manager.messages_now(user_id=user_id))
 
     @app.on_message(filters.command("start"))
@@ -82,46 +118,53 @@ def register_handlers(app, manager, authorized_users):
         logger.info(f"Received /start command from user {user_id}.")
         bot_info = "Hello! Welcome to the bot.\n"
         logger.info(f"Processed /start command for user {user_id}.")
-        await app.send_message(message.chat.id, bot_info)
+        await manager.send_message(message.chat.id, bot_info)
 
     @app.on_message(filters.command("list"))
     async def list_command(client, message):
         user_id = message.from_user.id
         logger.info(f"Received /list command from user {user_id}.")
+        await manager.started.wait()
         if user_id not in authorized_users:
-            await app.send_message(message.chat.id, "You are not authorized to use this command.")
+            await manager.send_message(message.chat.id, "You are not authorized to use this command.")
             logger.warning(f"Unauthorized access attempt by user {user_id}.")
             return
+        args = message.command[1:]
+        page = 1
+        if args and args[-1].isdigit():
+            page = int(args.pop())
         try:
-            await manager.list(user_id)
+            await manager.list(user_id, " ".join(args), page)
         except Exception:
-            await app.send_message(message.chat.id, "Unknown error executing /list command. Please try again later")
+            await manager.send_message(message.chat.id, "Unknown error executing /list command. Please try again later")
 
     @app.on_message(filters.command("list_current"))
     async def list_current_command(client, message):
         user_id = message.from_user.id
         logger.info(f"Received /list_current command from user {user_id}.")
+        await manager.started.wait()
         if user_id not in authorized_users:
-            await app.send_message(message.chat.id, "You are not authorized to use this command.")
+            await manager.send_message(message.chat.id, "You are not authorized to use this command.")
             logger.warning(f"Unauthorized access attempt by user {user_id}.")
             return
         try:
             await manager.list_all_current_chats(user_id)
         except Exception:
-            await app.send_message(message.chat.id, "Unknown error executing /list_current command. Please try again later")
+            await manager.send_message(message.chat.id, "Unknown error executing /list_current command. Please try again later")
 
     @app.on_message(filters.command("id"))
     async def id_command(client, message):
         user_id = message.from_user.id
         logger.info(f"Received /id command from user {user_id}.")
-        await app.send_message(message.chat.id, f"Your user ID is: {user_id}")
+        await manager.send_message(message.chat.id, f"Your user ID is: {user_id}")
 
     @app.on_message(filters.command("remove"))
     async def remove_command(client, message):
         user_id = message.from_user.id
         logger.info(f"Received /remove command from user {user_id}.")
+        await manager.started.wait()
         if user_id not in authorized_users:
-            await app.send_message(message.chat.id, "You are not authorized to use this command.")
+            await manager.send_message(message.chat.id, "You are not authorized to use this command.")
             logger.warning(f"Unauthorized access attempt by user {user_id}.")
             return
         await manager.remove_info(user_id)
@@ -0,0 +1,288 @@
+import asyncio
+import json
+import logging
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from functools import partial
+
+from pyrogram.errors import FloodWait
+from pyrogram.handlers import MessageHandler
+
+from src.extract import MessageFilter, extract_record
+from src.message_cache import SHARED_OWNER, cache_owner, is_global_chat
+from src.metrics import FLOOD_WAITS, LIVE_MESSAGES, MESSAGES_FETCHED, span
+from src.rate_limit import TokenBucket
+from src.session_pool import PooledSession, SessionPool
+from src.storage import write_json_atomic
+
+logger = logging.getLogger(__name__)
+
+WINDOW_HOURS = 48
+
+
+class ChatBuffer:
+    __slots__ = ("messages", "covered_from", "last_id", "listeners", "live", "filter")
+
+    def __init__(self, max_messages: int, skip_bots: bool = True):
+        self.messages = deque(maxlen=max_messages)
+        self.covered_from = None
+        self.last_id = 0
+        self.listeners = 0
+        self.live = False
+        self.filter = MessageFilter(skip_bots=skip_bots)
+
+    def add(self, message_id: int, date: float, line: str):
+        if message_id <= self.last_id:
+            # several subscribers of a channel or supergroup receive the same update
+            return
+        full = len(self.messages) == self.messages.maxlen
+        self.messages.append((message_id, date, line))
+        self.last_id = message_id
+        if full:
+            # the oldest message fell out of the ring, coverage now starts at the next one
+            self.covered_from = max(self.covered_from or 0, self.messages[0][1])
+
+    def merge(self, rows: list, covered_from: float):
+        merged = {i[0]: i for i in self.messages}
+        merged.update((i[0], i) for i in rows)
+        ordered = [merged[i] for i in sorted(merged)]
+        if len(ordered) > self.messages.maxlen:
+            ordered = ordered[-self.messages.maxlen:]
+            covered_from = max(covered_from, ordered[0][1])
+        self.messages = deque(ordered, maxlen=self.messages.maxlen)
+        self.last_id = ordered[-1][0] if ordered else self.last_id
+        self.covered_from = covered_from
+
+
+class LiveBuffer:
+    def __init__(self, filename: str = None, max_messages: int = 2000, skip_bots: bool = True):
+        self.filename = filename
+        self.max_messages = max_messages
+        self.skip_bots = skip_bots
+        # keyed by (owner, chat_id) like the message cache, only channels and supergroups share a buffer
+        self.chats: dict[tuple, ChatBuffer] = {}
+
+    def chat(self, user_id: int, chat_id: int) -> ChatBuffer:
+        key = (cache_owner(user_id, chat_id), chat_id)
+        buffer = self.chats.get(key)
+        if buffer is None:
+            buffer = self.chats[key] = ChatBuffer(self.max_messages, self.skip_bots)
+        return buffer
+
+    def get(self, user_id: int, chat_id: int) -> ChatBuffer | None:
+        return self.chats.get((cache_owner(user_id, chat_id), chat_id))
+
+    def append(self, user_id: int, chat_id: int, message):
+        buffer = self.get(user_id, chat_id)
+        if buffer is None or not buffer.listeners:
+            return
+        message.date = message.date.astimezone(timezone.utc)
+        record = extract_record(message, buffer.filter)
+        if record is not None:
+            buffer.add(record.message_id, message.date.timestamp(), record.line())
+            LIVE_MESSAGES.inc()
+
+    def covers(self, user_id: int, chat_id: int, since: datetime) -> bool:
+        since = max(since, datetime.now(timezone.utc) - timedelta(hours=WINDOW_HOURS))
+        buffer = self.get(user_id, chat_id)
+        return (buffer is not None and buffer.live and buffer.covered_from is not None
+                and buffer.covered_from <= since.timestamp())
+
+    def lines(self, user_id: int, chat_id: int, since: datetime) -> list | None:
+        # None means the buffer can't answer for this window and history has to be fetched instead
+        if not self.covers(user_id, chat_id, since):
+            return None
+        since = max(since, datetime.now(timezone.utc) - timedelta(hours=WINDOW_HOURS)).timestamp()
+        return [line for _, date, line in self.get(user_id, chat_id).messages if date >= since]
+
+    def load(self):
+        if self.filename is None:
+            return
+        try:
+            with open(self.filename, 'r') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logger.error(f"Could not read live buffer {self.filename}, starting empty: {e}")
+            return
+        for key, item in data.items():
+            chat_id = int(key.split(":")[-1])
+            if "owner" not in item and not is_global_chat(chat_id):
+                # saved before buffers were kept per user, nothing says whose private chat this was
+                continue
+            buffer = self.chat(item.get("owner", SHARED_OWNER), chat_id)
+            buffer.merge([tuple(i) for i in item["messages"]], item["covered_from"])
+            buffer.last_id = max(buffer.last_id, item["last_id"])
+        logger.info(f"Restored live buffers of {len(data)} chats")
+
+    def save(self):
+        if self.filename is None:
+            return
+        cutoff = (datetime.now(timezone.utc) - timedelta(hours=WINDOW_HOURS)).timestamp()
+        data = {}
+        for (owner, chat_id), buffer in self.chats.items():
+            if buffer.covered_from is None:
+                continue
+            data[f"{owner}:{chat_id}"] = {
+                "owner": owner,
+                "covered_from": max(buffer.covered_from, cutoff),
+                "last_id": buffer.last_id,
+                "messages": [i for i in buffer.messages if i[1] >= cutoff],
+            }
+        write_json_atomic(self.filename, json.dumps(data))
+        logger.info(f"Saved live buffers of {len(data)} chats")
+
+
+class Subscription:
+    def __init__(self, entry: PooledSession):
+        self.entry = entry
+        self.chats = set()
+        self.handler = None
+
+
+class LiveIngest:
+    def __init__(self, buffer: LiveBuffer, session_pool: SessionPool, limiter: TokenBucket,
+                 max_subscriptions: int = None):
+        self.buffer = buffer
+        self.session_pool = session_pool
+        self.limiter = limiter
+        # leave room in the pool for users whose chats are still polled
+        self.max_subscriptions = max_subscriptions or max(1, session_pool.max_sessions - 1)
+        self.subscriptions: dict[int, Subscription] = {}
+        self.tasks = set()
+
+    async def on_message(self, subscription: Subscription, client, message):
+        if message.chat is not None and message.chat.id in subscription.chats:
+            self.buffer.append(subscription.entry.user_id, message.chat.id, message)
+
+    async def subscribe(self, user_id: int, phone: str, chats) -> bool:
+        subscription = self.subscriptions.get(user_id)
+        if subscription is None:
+            if len(self.subscriptions) >= self.max_subscriptions:
+                logger.warning(f"No session left for live updates of user {user_id}, polling history instead")
+                return False
+            # the session stays acquired so the pool never evicts a listening client
+            entry = await self.session_pool.acquire(user_id, phone)
+            subscription = self.subscriptions[user_id] = Subscription(entry)
+            subscription.handler = MessageHandler(partial(self.on_message, subscription))
+            entry.client.add_handler(subscription.handler)
+            entry.on_restart = partial(self.restarted, user_id)
+            logger.info(f"Listening for new messages of user {user_id}")
+        for chat_id in chats:
+            await self.track(user_id, chat_id)
+        return True
+
+    async def unsubscribe(self, user_id: int):
+        subscription = self.subscriptions.get(user_id)
+        if subscription is None:
+            return
+        for chat_id in list(subscription.chats):
+            self.untrack(user_id, chat_id)
+        self.subscriptions.pop(user_id)
+        subscription.entry.on_restart = None
+        try:
+            subscription.entry.client.remove_handler(subscription.handler)
+        except Exception as e:
+            logger.warning(f"Error removing update handler of user {user_id}: {e}")
+        await self.session_pool.release(subscription.entry)
+
+    async def track(self, user_id: int, chat_id: int):
+        subscription = self.subscriptions.get(user_id)
+        if subscription is None or chat_id in subscription.chats:
+            return
+        subscription.chats.add(chat_id)
+        buffer = self.buffer.chat(user_id, chat_id)
+        buffer.listeners += 1
+        if buffer.listeners == 1:
+            try:
+                await self.catch_up(subscription.entry.client, user_id, chat_id)
+            except Exception as e:
+                logger.error(f"Error catching up chat {chat_id}, polling history until it is live: {e}")
+
+    def restarted(self, user_id: int):
+        subscription = self.subscriptions.get(user_id)
+        if subscription is None:
+            return
+        # updates were lost while the client was down, no buffer can answer until it has caught up again
+        for chat_id in subscription.chats:
+            self.buffer.chat(user_id, chat_id).live = False
+        task = asyncio.create_task(self.resume(user_id, subscription))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def resume(self, user_id: int, subscription: Subscription):
+        client = subscription.entry.client
+        try:
+            client.remove_handler(subscription.handler)
+        except Exception:
+            pass
+        client.add_handler(subscription.handler)
+        logger.info(f"Session of user {user_id} restarted, catching up its live chats")
+        for chat_id in list(subscription.chats):
+            try:
+                await self.catch_up(client, user_id, chat_id)
+            except Exception as e:
+                logger.error(f"Error catching up chat {chat_id}, polling history until it is live: {e}")
+
+    def untrack(self, user_id: int, chat_id: int):
+        subscription = self.subscriptions.get(user_id)
+        if subscription is None or chat_id not in subscription.chats:
+            return
+        subscription.chats.discard(chat_id)
+        buffer = self.buffer.chat(user_id, chat_id)
+        buffer.listeners -= 1
+        if not buffer.listeners:
+            buffer.live = False
+
+    async def catch_up(self, client, user_id: int, chat_id: int):
+        # fill the gap since the last buffered message, or the whole window for a new buffer
+        buffer = self.buffer.chat(user_id, chat_id)
+        window_start = (datetime.now(timezone.utc) - timedelta(hours=WINDOW_HOURS)).timestamp()
+        limit = buffer.messages.maxlen
+        # live updates can move last_id while history is read, so remember where the stored part ends
+        last_id, restored_from = buffer.last_id, buffer.covered_from
+        with span("catch_up", chat=chat_id):
+            while True:
+                rows = []
+                fetched = 0
+                oldest = None
+                covered_from = None
+                try:
+                    async for message in client.get_chat_history(chat_id, limit=limit):
+                        # get_chat_history pulls pages of 100, account for each page request
+                        if fetched % 100 == 0:
+                            await self.limiter.acquire()
+                        fetched += 1
+                        if restored_from is not None and message.id <= last_id:
+                            covered_from = restored_from
+                            break
+                        message.date = message.date.astimezone(timezone.utc)
+                        oldest = message.date.timestamp()
+                        if oldest < window_start:
+                            covered_from = window_start
+                            break
+                        record = extract_record(message, buffer.filter)
+                        if record is not None:
+                            rows.append((record.message_id, oldest, record.line()))
+                    else:
+                        # either the limit was hit or the chat has no older history
+                        covered_from = oldest if fetched >= limit else window_start
+                    break
+                except FloodWait as e:
+                    FLOOD_WAITS.inc(api="telegram")
+                    logger.warning(f"FloodWait of {e.value}s catching up chat {chat_id}")
+                    self.limiter.penalise(e.value)
+                finally:
+                    MESSAGES_FETCHED.inc(fetched)
+        buffer.merge(rows, covered_from)
+        buffer.live = buffer.listeners > 0
+        logger.info(f"Caught up chat {chat_id} with {len(rows)} messages, live from now on")
+
+    async def close(self):
+        for task in list(self.tasks):
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        for user_id in list(self.subscriptions):
+            await self.unsubscribe(user_id)
+        self.buffer.save()
@@ -0,0 +1,179 @@
+import asyncio
+import importlib
+import logging
+import random
+import re
+
+from src.chunking import get_token_counter
+from src.metrics import LLM_RETRIES, LLM_SEMAPHORE_WAIT, LLM_TOKENS
+from src.rate_limit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+
+def api_errors() -> tuple:
+    from openai import APIConnectionError, APIStatusError, APITimeoutError
+    return APIConnectionError, APITimeoutError, APIStatusError
+
+
+def is_status_error(error: Exception) -> bool:
+    from openai import APIStatusError
+    return isinstance(error, APIStatusError)
+
+
+def parse_retry_after(headers) -> float | None:
+    if not headers:
+        return None
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if value:
+        try:
+            return float(value)
+        except ValueError:
+            pass
+    # OpenAI rate-limit headers look like "1s", "6m0s" or "250ms"
+    delays = []
+    for name in ("x-ratelimit-reset-requests", "x-ratelimit-reset-tokens"):
+        value = headers.get(name)
+        if not value:
+            continue
+        seconds = 0.0
+        for amount, unit in re.findall(r"([\d.]+)(ms|s|m|h)", value):
+            seconds += float(amount) * {"ms": 0.001, "s": 1, "m": 60, "h": 3600}[unit]
+        delays.append(seconds)
+    return max(delays) if delays else None
+
+
+class LLMClient:
+    def __init__(self, api_key, base_url=None, max_concurrency: int = 5, timeout: float = 120.0,
+                 connect_timeout: float = 10.0, max_retries: int = 4, backoff_base: float = 1.0,
+                 backoff_max: float = 60.0, request_limiter: TokenBucket = None, token_limiter: TokenBucket = None):
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.request_limiter = request_limiter
+        self.token_limiter = token_limiter
+        self.api_key = api_key
+        self.base_url = base_url
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.openai = None
+
+    @property
+    def client(self):
+        if self.openai is None:
+            # openai takes about half a second to import, the bot answers commands before paying for it
+            import httpx
+            from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+            http_client = DefaultAsyncHttpxClient(
+                limits=httpx.Limits(max_connections=self.max_concurrency,
+                                    max_keepalive_connections=self.max_concurrency),
+                timeout=httpx.Timeout(self.timeout, connect=self.connect_timeout),
+            )
+            # retries are handled here so they can honour rate-limit headers and share the semaphore
+            self.openai = AsyncOpenAI(api_key=self.api_key, base_url=self.base_url, max_retries=0,
+                                      http_client=http_client)
+        return self.openai
+
+    async def warm_up(self):
+        # import off the event loop, creating the client afterwards is cheap
+        await asyncio.to_thread(importlib.import_module, "openai")
+        return self.client
+
+    def backoff(self, attempt: int, error: Exception) -> float:
+        delay = min(self.backoff_max, self.backoff_base * (2 ** attempt))
+        delay = random.uniform(delay / 2, delay)
+        if is_status_error(error):
+            retry_after = parse_retry_after(error.response.headers)
+            if retry_after is not None:
+                delay = max(delay, min(retry_after, self.backoff_max))
+        return delay
+
+    async def wait_for_budget(self, tokens: int):
+        if self.request_limiter is not None:
+            await self.request_limiter.acquire()
+        if self.token_limiter is not None:
+            await self.token_limiter.acquire(tokens)
+
+    def count_tokens(self, chat_messages: list, model: str) -> int:
+        if self.token_limiter is None:
+            return 0
+        return sum(get_token_counter(model).count(i["content"]) for i in chat_messages)
+
+    def retry_delay(self, attempt: int, error: Exception) -> float:
+        retryable = not is_status_error(error) or error.status_code in RETRYABLE_STATUS
+        if not retryable or attempt >= self.max_retries:
+            raise error
+        delay = self.backoff(attempt, error)
+        if is_status_error(error) and error.status_code == 429 and self.request_limiter is not None:
+            self.request_limiter.penalise(delay)
+        LLM_RETRIES.inc(reason=error.__class__.__name__)
+        logger.warning(f"OpenAI request failed ({error.__class__.__name__}), retry {attempt + 1} in {delay:.1f}s")
+        return delay
+
+    def record_usage(self, usage):
+        if usage is not None:
+            LLM_TOKENS.inc(usage.prompt_tokens or 0, direction="in")
+            LLM_TOKENS.inc(usage.completion_tokens or 0, direction="out")
+
+    async def complete(self, chat_messages: list, model: str) -> str:
+        attempt = 0
+        tokens = self.count_tokens(chat_messages, model)
+        while True:
+            await self.wait_for_budget(tokens)
+            try:
+                with LLM_SEMAPHORE_WAIT.time():
+                    await self.semaphore.acquire()
+                try:
+                    chat_completion = await self.client.chat.completions.create(
+                        messages=chat_messages, model=model, store=False)
+                finally:
+                    self.semaphore.release()
+                self.record_usage(chat_completion.usage)
+                return chat_completion.choices[0].message.content
+            except api_errors() as e:
+                delay = self.retry_delay(attempt, e)
+                attempt += 1
+                await asyncio.sleep(delay)
+
+    async def stream(self, chat_messages: list, model: str):
+        attempt = 0
+        tokens = self.count_tokens(chat_messages, model)
+        while True:
+            await self.wait_for_budget(tokens)
+            emitted = False
+            try:
+                with LLM_SEMAPHORE_WAIT.time():
+                    await self.semaphore.acquire()
+                try:
+                    stream = await self.client.chat.completions.create(
+                        messages=chat_messages, model=model, store=False, stream=True,
+                        stream_options={"include_usage": True})
+                    async for chunk in stream:
+                        self.record_usage(chunk.usage)
+                        if chunk.choices and chunk.choices[0].delta.content:
+                            emitted = True
+                            yield chunk.choices[0].delta.content
+                finally:
+                    self.semaphore.release()
+                return
+            except api_errors() as e:
+                # a half-delivered answer can't be retried transparently
+                if emitted:
+                    raise e
+                delay = self.retry_delay(attempt, e)
+                attempt += 1
+                await asyncio.sleep(delay)
+
+    async def close(self):
+        if self.openai is not None:
+            await self.openai.close()
@@ -0,0 +1,84 @@
+import asyncio
+import logging
+import sqlite3
+import threading
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+# channels and supergroups get -100 prefixed ids that are the same for every account
+MAX_CHANNEL_ID = -1000000000000
+# rows of global chats are stored once under this owner instead of once per reader
+SHARED_OWNER = 0
+SCHEMA_VERSION = 1
+
+
+def is_global_chat(chat_id: int) -> bool:
+    # private chats and basic groups are numbered per account, a DM's id is the other person's user id
+    return chat_id < MAX_CHANNEL_ID
+
+
+def cache_owner(user_id: int, chat_id: int) -> int:
+    return SHARED_OWNER if is_global_chat(chat_id) else user_id
+
+
+class MessageCache:
+    def __init__(self, filename: str, retention_hours: int = 50):
+        self.filename = filename
+        self.retention = retention_hours * 3600
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        if self.db.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+            # older caches were keyed by chat id alone and mixed up private chats of different users
+            self.db.execute("DROP TABLE IF EXISTS messages")
+            self.db.execute("DROP TABLE IF EXISTS chats")
+            self.db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        self.db.execute("CREATE TABLE IF NOT EXISTS messages (owner INTEGER, chat_id INTEGER, message_id INTEGER, "
+                        "date REAL, line TEXT, PRIMARY KEY (owner, chat_id, message_id))")
+        self.db.execute("CREATE TABLE IF NOT EXISTS chats (owner INTEGER, chat_id INTEGER, max_id INTEGER, "
+                        "covered_from REAL, PRIMARY KEY (owner, chat_id))")
+        self.db.commit()
+
+    def _state(self, user_id: int, chat_id: int):
+        with self.lock:
+            return self.db.execute("SELECT max_id, covered_from FROM chats WHERE owner = ? AND chat_id = ?",
+                                   (cache_owner(user_id, chat_id), chat_id)).fetchone()
+
+    def _store(self, user_id: int, chat_id: int, rows: list, max_id: int, covered_from: float):
+        owner = cache_owner(user_id, chat_id)
+        cutoff = datetime.now(timezone.utc).timestamp() - self.retention
+        with self.lock, self.db:
+            self.db.executemany("INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?)",
+                                [(owner, chat_id, message_id, date, line) for message_id, date, line in rows])
+            self.db.execute("INSERT OR REPLACE INTO chats VALUES (?, ?, ?, ?)",
+                            (owner, chat_id, max_id, max(covered_from, cutoff)))
+            self.db.execute("DELETE FROM messages WHERE owner = ? AND chat_id = ? AND date < ?",
+                            (owner, chat_id, cutoff))
+
+    def _lines(self, user_id: int, chat_id: int, since: float) -> list:
+        with self.lock:
+            rows = self.db.execute("SELECT line FROM messages WHERE owner = ? AND chat_id = ? AND date >= ? "
+                                   "ORDER BY message_id", (cache_owner(user_id, chat_id), chat_id, since)).fetchall()
+        return [i[0] for i in rows]
+
+    def _forget_user(self, user_id: int):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM messages WHERE owner = ?", (user_id,))
+            self.db.execute("DELETE FROM chats WHERE owner = ?", (user_id,))
+
+    async def state(self, user_id: int, chat_id: int):
+        return await asyncio.to_thread(self._state, user_id, chat_id)
+
+    async def store(self, user_id: int, chat_id: int, rows: list, max_id: int, covered_from: float):
+        await asyncio.to_thread(self._store, user_id, chat_id, rows, max_id, covered_from)
+
+    async def lines(self, user_id: int, chat_id: int, since: datetime) -> list:
+        return await asyncio.to_thread(self._lines, user_id, chat_id, since.timestamp())
+
+    async def forget_user(self, user_id: int):
+        await asyncio.to_thread(self._forget_user, user_id)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,180 @@
+import asyncio
+import contextvars
+import logging
+import time
+import uuid
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+def format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{k}="{str(v)}"' for k, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        REGISTRY.append(self)
+
+    def key(self, labels: dict) -> tuple:
+        return tuple(labels.get(i, "") for i in self.labelnames)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for values, value in self.values.items():
+            lines.append(f"{self.name}{format_labels(self.labelnames, values)} {value}")
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        super().__init__(name, documentation, labelnames)
+        self.function = None
+
+    def set(self, value: float, **labels):
+        self.values[self.key(labels)] = value
+
+    def set_function(self, function):
+        self.function = function
+
+    def render(self) -> list:
+        if self.function is not None:
+            self.values[()] = self.function()
+        return super().render()
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = buckets
+
+    def observe(self, value: float, **labels):
+        key = self.key(labels)
+        entry = self.values.get(key)
+        if entry is None:
+            entry = self.values[key] = [[0] * len(self.buckets), 0, 0.0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                entry[0][i] += 1
+        entry[1] += 1
+        entry[2] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for values, (counts, count, total) in self.values.items():
+            for bound, bucket_count in zip(self.buckets, counts):
+                labels = format_labels(self.labelnames, values, 'le="%s"' % bound)
+                lines.append(f"{self.name}_bucket{labels} {bucket_count}")
+            labels = format_labels(self.labelnames, values, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{labels} {count}")
+            lines.append(f"{self.name}_count{format_labels(self.labelnames, values)} {count}")
+            lines.append(f"{self.name}_sum{format_labels(self.labelnames, values)} {total}")
+        return lines
+
+
+REGISTRY = []
+
+STAGE_SECONDS = Histogram("summary_bot_stage_seconds", "Latency of pipeline stages", ("stage",))
+FLOOD_WAITS = Counter("summary_bot_flood_waits_total", "FloodWait errors received", ("api",))
+LLM_RETRIES = Counter("summary_bot_llm_retries_total", "Retried OpenAI requests", ("reason",))
+LLM_TOKENS = Counter("summary_bot_llm_tokens_total", "OpenAI tokens used", ("direction",))
+LLM_SEMAPHORE_WAIT = Histogram("summary_bot_llm_semaphore_wait_seconds", "Time waiting for an OpenAI slot")
+QUEUE_DEPTH = Gauge("summary_bot_queue_depth", "Summary jobs waiting in the queue")
+QUEUE_WAIT = Histogram("summary_bot_queue_wait_seconds", "Time a summary job waited in the queue")
+CACHE_REQUESTS = Counter("summary_bot_cache_requests_total", "Cache lookups", ("cache", "result"))
+MESSAGES_FETCHED = Counter("summary_bot_messages_fetched_total", "Messages fetched from Telegram history")
+LIVE_MESSAGES = Counter("summary_bot_live_messages_total", "Messages buffered from update handlers")
+ROUTE_CHATS = Counter("summary_bot_route_chats_total", "Chats summarised per route", ("route",))
+ROUTE_TOKENS = Counter("summary_bot_route_tokens_total", "Transcript tokens handled per route", ("route",))
+ROUTE_SECONDS = Histogram("summary_bot_route_seconds", "Time to summarise one chat per route", ("route",))
+ENRICHED_MEDIA = Counter("summary_bot_enriched_media_total", "Media files turned into text", ("extractor",))
+ACTIVE_SESSIONS = Gauge("summary_bot_active_sessions", "Connected user sessions")
+OUTBOX_DEPTH = Gauge("summary_bot_outbox_depth", "Bot messages and edits waiting to be delivered")
+OUTBOX_MESSAGES = Counter("summary_bot_outbox_messages_total", "Bot messages and edits by outcome", ("kind", "result"))
+STARTUP_SECONDS = Gauge("summary_bot_startup_seconds", "Seconds from process start until a startup phase finished",
+                        ("phase",))
+
+
+def render() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def start_trace() -> str:
+    trace_id = uuid.uuid4().hex[:16]
+    current_trace.set(trace_id)
+    return trace_id
+
+
+@contextmanager
+def span(stage: str, **attributes):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_SECONDS.observe(elapsed, stage=stage)
+        trace_id = current_trace.get()
+        if trace_id is not None:
+            details = " ".join(f"{k}={v}" for k, v in attributes.items())
+            logger.debug(f"trace={trace_id} span={stage} {elapsed * 1000:.1f}ms {details}".rstrip())
+
+
+async def handle_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request = await asyncio.wait_for(reader.readline(), timeout=10)
+        while (await asyncio.wait_for(reader.readline(), timeout=10)) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request.decode(errors="replace").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            status, body = "200 OK", render().encode()
+        else:
+            status, body = "404 Not Found", b"Not Found\n"
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                     f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+    except Exception as e:
+        logger.warning(f"Error serving metrics: {e}")
+    finally:
+        writer.close()
+
+
+async def start_metrics_server(host: str, port: int) -> asyncio.AbstractServer:
+    server = await asyncio.start_server(handle_request, host, port)
+    logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
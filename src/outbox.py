@@ -0,0 +1,171 @@
+import asyncio
+import logging
+from collections import deque
+
+from pyrogram.errors import FloodWait, MessageNotModified
+
+from src.metrics import FLOOD_WAITS, OUTBOX_MESSAGES, span
+from src.rate_limit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+
+class OutboxChat:
+    __slots__ = ("id",)
+
+    def __init__(self, chat_id: int):
+        self.id = chat_id
+
+
+class OutgoingMessage:
+    # handed out before the message exists, id is filled in once it is sent
+    __slots__ = ("chat", "id", "text", "delivered")
+
+    def __init__(self, chat_id: int, text: str, message_id: int = None):
+        self.chat = OutboxChat(chat_id)
+        self.id = message_id
+        self.text = text
+        self.delivered = asyncio.get_running_loop().create_future()
+        if message_id is not None:
+            self.delivered.set_result(self)
+
+
+class Envelope:
+    __slots__ = ("message", "text", "edit", "status", "future")
+
+    def __init__(self, message: OutgoingMessage, text: str, edit: bool, status: bool = False):
+        self.message = message
+        self.text = text
+        self.edit = edit
+        self.status = status
+        # sends resolve through the message itself, edits get their own future
+        self.future = asyncio.get_running_loop().create_future() if edit else message.delivered
+
+
+class Outbox:
+    def __init__(self, app, limiter: TokenBucket, chat_rate: float = 1.0, chat_burst: float = 3,
+                 max_attempts: int = 5):
+        self.app = app
+        self.limiter = limiter
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_attempts = max_attempts
+        self.queues: dict[int, deque] = {}
+        self.chat_limiters: dict[int, TokenBucket] = {}
+        self.senders: dict[int, asyncio.Task] = {}
+
+    def depth(self) -> int:
+        return sum(len(i) for i in self.queues.values())
+
+    def send(self, chat_id: int, text: str, status: bool = False) -> OutgoingMessage:
+        queue = self.queues.get(chat_id)
+        if status and queue and queue[-1].status:
+            # notices queued back to back go out as one message, repeats are dropped
+            last = queue[-1]
+            if text not in last.text.split("\n"):
+                last.text = last.message.text = f"{last.text}\n{text}"
+            OUTBOX_MESSAGES.inc(kind="send", result="merged")
+            return last.message
+        message = OutgoingMessage(chat_id, text)
+        self.enqueue(chat_id, Envelope(message, text, edit=False, status=status))
+        return message
+
+    def edit(self, message, text: str) -> asyncio.Future:
+        if not isinstance(message, OutgoingMessage):
+            message = OutgoingMessage(message.chat.id, message.text or "", message.id)
+        for envelope in self.queues.get(message.chat.id, ()):
+            same = envelope.message is message or (message.id is not None and envelope.message.id == message.id)
+            if not same:
+                continue
+            # only the newest text matters, an unsent message simply goes out with it
+            envelope.text = text
+            envelope.status = False
+            OUTBOX_MESSAGES.inc(kind="edit", result="merged")
+            return envelope.future
+        envelope = Envelope(message, text, edit=True)
+        self.enqueue(message.chat.id, envelope)
+        return envelope.future
+
+    def enqueue(self, chat_id: int, envelope: Envelope):
+        self.queues.setdefault(chat_id, deque()).append(envelope)
+        if chat_id not in self.senders:
+            self.senders[chat_id] = asyncio.create_task(self.run(chat_id))
+
+    def chat_limiter(self, chat_id: int) -> TokenBucket:
+        limiter = self.chat_limiters.get(chat_id)
+        if limiter is None:
+            limiter = self.chat_limiters[chat_id] = TokenBucket(f"Bot chat {chat_id}", self.chat_rate,
+                                                                 self.chat_burst)
+        return limiter
+
+    async def run(self, chat_id: int):
+        # one sender per recipient keeps its messages in order without holding up anyone else
+        queue = self.queues[chat_id]
+        envelope = None
+        try:
+            while queue:
+                envelope = queue.popleft()
+                try:
+                    result = await self.deliver(chat_id, envelope)
+                except Exception as e:
+                    logger.error(f"Could not deliver message to {chat_id}: {e}")
+                    OUTBOX_MESSAGES.inc(kind="edit" if envelope.edit else "send", result="failed")
+                    result = None
+                self.resolve(envelope, result)
+        finally:
+            # cancelled on shutdown, nothing left in the queue will be sent
+            for envelope in [envelope, *queue] if envelope is not None else queue:
+                self.resolve(envelope, None)
+            self.senders.pop(chat_id, None)
+            self.queues.pop(chat_id, None)
+
+    def resolve(self, envelope: Envelope, result):
+        if envelope.future.done():
+            return
+        message = envelope.message
+        if result is not None:
+            message.text = envelope.text
+            if not envelope.edit:
+                message.id = result.id
+        # failures resolve to None instead of raising, most callers never look at the result
+        envelope.future.set_result(message if result is not None else None)
+
+    async def deliver(self, chat_id: int, envelope: Envelope):
+        limiter = self.chat_limiter(chat_id)
+        kind = "edit" if envelope.edit else "send"
+        for attempt in range(self.max_attempts):
+            await limiter.acquire()
+            await self.limiter.acquire()
+            try:
+                with span(f"bot_{kind}"):
+                    if not envelope.edit:
+                        result = await self.app.send_message(chat_id=chat_id, text=envelope.text)
+                    elif envelope.message.id is None:
+                        raise ValueError("edited message was never sent")
+                    else:
+                        result = await self.app.edit_message_text(chat_id=chat_id, message_id=envelope.message.id,
+                                                                  text=envelope.text)
+                OUTBOX_MESSAGES.inc(kind=kind, result="sent")
+                return result
+            except MessageNotModified:
+                return envelope.message
+            except FloodWait as e:
+                # nothing was delivered, so both sends and edits can simply wait and go again
+                FLOOD_WAITS.inc(api="bot")
+                limiter.penalise(e.value)
+            except (OSError, asyncio.TimeoutError) as e:
+                # a send may have gone through before the connection broke, retrying could duplicate it
+                if not envelope.edit or attempt == self.max_attempts - 1:
+                    raise e
+                logger.warning(f"Retrying edit for {chat_id} after {e}")
+                await asyncio.sleep(min(2 ** attempt, 30))
+        raise RuntimeError(f"gave up after {self.max_attempts} attempts")
+
+    async def close(self, timeout: float = 10.0):
+        senders = list(self.senders.values())
+        if senders:
+            logger.info(f"Delivering {self.depth()} queued bot messages")
+            _, pending = await asyncio.wait(senders, timeout=timeout)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
@@ -0,0 +1,94 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+# add_user used to store this as a placeholder interval, it means "no automatic digests"
+LEGACY_NO_SCHEDULE = 666
+
+
+class UserRecord:
+    __slots__ = ("user_id", "hours", "last_called", "phone", "chats", "next_run")
+
+    def __init__(self, user_id: int, hours: int, last_called: str = None, phone: str = None, chats=(),
+                 next_run: float = None):
+        self.user_id = user_id
+        self.hours = hours
+        self.last_called = last_called
+        self.phone = phone
+        self.chats = set(chats)
+        self.next_run = next_run
+
+    @classmethod
+    def from_list(cls, item: list) -> "UserRecord":
+        # stored as [user_id, hours, last_called, phone, chats, next_run], older records stop after chats
+        item = list(item) + [None] * (6 - len(item))
+        hours = 0 if item[1] == LEGACY_NO_SCHEDULE else item[1]
+        return cls(item[0], hours, item[2], item[3], item[4] or (), item[5])
+
+    def to_list(self) -> list:
+        return [self.user_id, self.hours, self.last_called, self.phone, sorted(self.chats), self.next_run]
+
+
+class Registry:
+    def __init__(self):
+        self.users: dict[int, UserRecord] = {}
+        # chat_id -> users tracking it, kept in step with every record's chat set
+        self.subscribers: dict[int, set[int]] = {}
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self.users
+
+    def __iter__(self):
+        return iter(list(self.users.values()))
+
+    def __len__(self) -> int:
+        return len(self.users)
+
+    def get(self, user_id: int) -> UserRecord | None:
+        return self.users.get(user_id)
+
+    def load(self, data: dict):
+        self.users.clear()
+        self.subscribers.clear()
+        for item in data.values():
+            self.add(UserRecord.from_list(item))
+        logger.info(f"Loaded {len(self.users)} users tracking {len(self.subscribers)} chats")
+
+    def add(self, record: UserRecord):
+        self.remove(record.user_id)
+        self.users[record.user_id] = record
+        for chat_id in record.chats:
+            self.subscribers.setdefault(chat_id, set()).add(record.user_id)
+
+    def remove(self, user_id: int) -> UserRecord | None:
+        record = self.users.pop(user_id, None)
+        if record is not None:
+            for chat_id in record.chats:
+                self.unindex(chat_id, user_id)
+        return record
+
+    def add_chat(self, user_id: int, chat_id: int) -> bool:
+        record = self.users[user_id]
+        if chat_id in record.chats:
+            return False
+        record.chats.add(chat_id)
+        self.subscribers.setdefault(chat_id, set()).add(user_id)
+        return True
+
+    def remove_chat(self, user_id: int, chat_id: int) -> bool:
+        record = self.users[user_id]
+        if chat_id not in record.chats:
+            return False
+        record.chats.discard(chat_id)
+        self.unindex(chat_id, user_id)
+        return True
+
+    def unindex(self, chat_id: int, user_id: int):
+        users = self.subscribers.get(chat_id)
+        if users is not None:
+            users.discard(user_id)
+            if not users:
+                del self.subscribers[chat_id]
+
+    def subscribers_of(self, chat_id: int) -> set:
+        return set(self.subscribers.get(chat_id, ()))
@@ -0,0 +1,56 @@
+import logging
+import re
+
+from src.chunking import split_messages
+from src.metrics import ROUTE_CHATS, ROUTE_TOKENS
+
+logger = logging.getLogger(__name__)
+
+LINE_DATE = re.compile(r"^\[\d{4}-\d{2}-\d{2} (\d{2}:\d{2}):\d{2}[^\]]*\] ")
+
+
+class Route:
+    __slots__ = ("name", "model")
+
+    def __init__(self, name: str, model: str | None):
+        self.name = name
+        self.model = model
+
+    @property
+    def verbatim(self) -> bool:
+        return self.model is None
+
+
+class Router:
+    def __init__(self, model: str, cheap_model: str = None, verbatim_messages: int = 3, verbatim_tokens: int = 150,
+                 cheap_tokens: int = 4000, premium_chats=()):
+        self.verbatim_route = Route("verbatim", None)
+        self.cheap_route = Route("cheap", cheap_model) if cheap_model else None
+        self.full_route = Route("full", model)
+        self.verbatim_messages = verbatim_messages
+        self.verbatim_tokens = verbatim_tokens
+        self.cheap_tokens = cheap_tokens
+        self.premium_chats = {int(i) for i in premium_chats}
+
+    @property
+    def digest_model(self) -> str:
+        # digests only ever contain quiet chats, the cheap model is good enough for them
+        return (self.cheap_route or self.full_route).model
+
+    def route(self, chat_id: int, messages: int, tokens: int) -> Route:
+        if messages <= self.verbatim_messages and tokens <= self.verbatim_tokens:
+            route = self.verbatim_route
+        elif chat_id in self.premium_chats or self.cheap_route is None or tokens > self.cheap_tokens:
+            route = self.full_route
+        else:
+            route = self.cheap_route
+        logger.debug(f"Routing chat {chat_id} with {messages} messages, {tokens} tokens to {route.name}")
+        return route
+
+    def record(self, name: str, tokens: int):
+        ROUTE_CHATS.inc(route=name)
+        ROUTE_TOKENS.inc(tokens, route=name)
+
+
+def compact(text: str) -> str:
+    return "\n".join(LINE_DATE.sub(r"\1 ", i) for i in split_messages(text))
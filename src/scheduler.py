@@ -0,0 +1,64 @@
+import asyncio
+import heapq
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Scheduler:
+    def __init__(self, on_due):
+        self.on_due = on_due
+        self.heap = []
+        self.next_runs = {}
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    def schedule(self, user_id: int, run_at: float):
+        # superseded heap entries are skipped lazily when they reach the top
+        self.next_runs[user_id] = run_at
+        heapq.heappush(self.heap, (run_at, user_id))
+        self.wakeup.set()
+
+    def unschedule(self, user_id: int):
+        self.next_runs.pop(user_id, None)
+        self.wakeup.set()
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    def pop_due(self, now: float) -> list:
+        due = []
+        while self.heap:
+            run_at, user_id = self.heap[0]
+            if self.next_runs.get(user_id) != run_at:
+                heapq.heappop(self.heap)
+                continue
+            if run_at > now:
+                break
+            heapq.heappop(self.heap)
+            self.next_runs.pop(user_id)
+            due.append(user_id)
+        return due
+
+    async def run(self):
+        while True:
+            self.wakeup.clear()
+            now = time.time()
+            for user_id in self.pop_due(now):
+                try:
+                    self.on_due(user_id)
+                except Exception as e:
+                    logger.error(f"Error starting scheduled digest for user {user_id}: {e}")
+            timeout = self.heap[0][0] - time.time() if self.heap else None
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
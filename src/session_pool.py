@@ -0,0 +1,195 @@
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+
+from pyrogram import Client
+
+from src.metrics import span
+
+logger = logging.getLogger(__name__)
+
+
+class PooledSession:
+    def __init__(self, user_id: int, client: Client):
+        self.user_id = user_id
+        self.client = client
+        self.users = 0
+        self.last_used = time.monotonic()
+        self.lock = asyncio.Lock()
+        # called after the client was restarted, stopping a pyrogram client drops its update handlers
+        self.on_restart = None
+
+
+class SessionPool:
+    def __init__(self, api_id, api_hash, max_sessions: int = 20, idle_timeout: float = 900.0,
+                 health_interval: float = 60.0, workers: int = 5):
+        self.api_id = api_id
+        self.api_hash = api_hash
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.health_interval = health_interval
+        self.workers = workers
+        self.sessions: dict[int, PooledSession] = {}
+        # evicted clients still hold their session file until they have stopped
+        self.stopping: dict[int, asyncio.Task] = {}
+        self.condition = asyncio.Condition()
+        self.reaper = None
+
+    def create_client(self, phone: str) -> Client:
+        return Client(
+            name=phone.replace('+', ''),
+            api_id=self.api_id,
+            api_hash=self.api_hash,
+            phone_number=phone,
+            device_model="BOT",
+            system_version="Windows 10",
+            app_version="0.666",
+            workers=self.workers,
+        )
+
+    async def start(self):
+        if self.reaper is None:
+            self.reaper = asyncio.create_task(self.reap_forever())
+
+    @asynccontextmanager
+    async def session(self, user_id: int, phone: str):
+        entry = await self.acquire(user_id, phone)
+        try:
+            yield entry.client
+        finally:
+            await self.release(entry)
+
+    async def acquire(self, user_id: int, phone: str) -> PooledSession:
+        async with self.condition:
+            while True:
+                entry = self.sessions.get(user_id)
+                if entry is not None:
+                    break
+                if user_id in self.stopping:
+                    # a second Client on the same .session file would fight the old one for it
+                    await self.condition.wait()
+                    continue
+                if len(self.sessions) < self.max_sessions:
+                    entry = PooledSession(user_id, self.create_client(phone))
+                    self.sessions[user_id] = entry
+                    break
+                idle = [i for i in self.sessions.values() if i.users == 0]
+                if idle:
+                    victim = min(idle, key=lambda i: i.last_used)
+                    logger.info(f"Session pool full, evicting idle session of user {victim.user_id}")
+                    self.evict(victim)
+                    continue
+                await self.condition.wait()
+            entry.users += 1
+        try:
+            await self.ensure_connected(entry)
+        except Exception:
+            await self.release(entry)
+            raise
+        return entry
+
+    async def release(self, entry: PooledSession):
+        async with self.condition:
+            entry.users -= 1
+            entry.last_used = time.monotonic()
+            self.condition.notify_all()
+
+    async def ensure_connected(self, entry: PooledSession, force: bool = False):
+        async with entry.lock:
+            client = entry.client
+            if client.is_connected and not force:
+                return
+            restarted = client.is_initialized
+            if restarted:
+                # connection dropped underneath a started client, restart it cleanly
+                try:
+                    await client.stop()
+                except Exception as e:
+                    logger.warning(f"Error stopping stale session of user {entry.user_id}: {e}")
+            logger.info(f"Starting session for user {entry.user_id}")
+            with span("session_connect", user=entry.user_id):
+                await client.start()
+        if restarted and entry.on_restart is not None:
+            entry.on_restart()
+
+    def evict(self, entry: PooledSession) -> asyncio.Task:
+        # must be called holding the condition, the entry stays tracked until its client has stopped
+        self.sessions.pop(entry.user_id, None)
+        task = self.stopping[entry.user_id] = asyncio.create_task(self.stop_evicted(entry))
+        self.condition.notify_all()
+        return task
+
+    async def stop_evicted(self, entry: PooledSession):
+        try:
+            await self.disconnect(entry)
+        finally:
+            async with self.condition:
+                self.stopping.pop(entry.user_id, None)
+                self.condition.notify_all()
+
+    async def disconnect(self, entry: PooledSession):
+        async with entry.lock:
+            if entry.client.is_connected:
+                try:
+                    await entry.client.stop()
+                except Exception as e:
+                    logger.warning(f"Error stopping session of user {entry.user_id}: {e}")
+        logger.info(f"Stopped session for user {entry.user_id}")
+
+    async def health_check(self, entry: PooledSession) -> bool:
+        try:
+            await asyncio.wait_for(entry.client.get_me(), timeout=15)
+            return True
+        except Exception as e:
+            logger.warning(f"Health check failed for user {entry.user_id}: {e}")
+            return False
+
+    async def reap_forever(self):
+        while True:
+            await asyncio.sleep(self.health_interval)
+            try:
+                await self.reap()
+            except Exception as e:
+                logger.error(f"Error in SessionPool.reap: {e}")
+
+    async def reap(self):
+        now = time.monotonic()
+        stopping = []
+        async with self.condition:
+            for entry in list(self.sessions.values()):
+                if entry.users == 0 and now - entry.last_used > self.idle_timeout:
+                    stopping.append(self.evict(entry))
+            alive = [i for i in self.sessions.values() if i.users == 0 and i.client.is_connected]
+            listening = [i for i in self.sessions.values() if i.on_restart is not None]
+        failed = [entry for entry in alive if not await self.health_check(entry)]
+        async with self.condition:
+            for entry in failed:
+                # only drop clients nobody picked up while get_me was running, the next acquire starts a fresh one
+                if entry.users == 0 and self.sessions.get(entry.user_id) is entry:
+                    stopping.append(self.evict(entry))
+        for entry in listening:
+            # listeners are never idle, a dead one would silently miss updates until something acquired it
+            if not entry.client.is_connected or not await self.health_check(entry):
+                try:
+                    await self.ensure_connected(entry, force=True)
+                except Exception as e:
+                    logger.error(f"Could not restart listening session of user {entry.user_id}: {e}")
+        await asyncio.gather(*stopping)
+
+    async def close_session(self, user_id: int):
+        async with self.condition:
+            entry = self.sessions.get(user_id)
+            task = self.evict(entry) if entry is not None else self.stopping.get(user_id)
+        if task is not None:
+            await task
+
+    async def close(self):
+        if self.reaper is not None:
+            self.reaper.cancel()
+            self.reaper = None
+        async with self.condition:
+            for entry in list(self.sessions.values()):
+                self.evict(entry)
+            stopping = list(self.stopping.values())
+        await asyncio.gather(*stopping)
@@ -0,0 +1,295 @@
+import asyncio
+import bisect
+import hashlib
+import json
+import logging
+import os
+import signal
+
+from src.registry import UserRecord
+
+logger = logging.getLogger(__name__)
+
+STREAM_LIMIT = 2 ** 24
+
+
+class RemoteError(Exception):
+    pass
+
+
+class HashRing:
+    def __init__(self, nodes=(), replicas: int = 100):
+        self.replicas = replicas
+        self.points = []
+        self.owners = {}
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def hash(key: str) -> int:
+        return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+    def add(self, node: int):
+        for replica in range(self.replicas):
+            point = self.hash(f"{node}:{replica}")
+            self.owners[point] = node
+            bisect.insort(self.points, point)
+
+    def node_for(self, key, alive=None):
+        # walk clockwise from the key and take the first live node
+        if not self.points:
+            return None
+        start = bisect.bisect(self.points, self.hash(str(key)))
+        for offset in range(len(self.points)):
+            node = self.owners[self.points[(start + offset) % len(self.points)]]
+            if alive is None or node in alive:
+                return node
+        return None
+
+
+class Connection:
+    # newline delimited JSON, either side can call methods named rpc_<method> on the other
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, handler):
+        self.reader = reader
+        self.writer = writer
+        self.handler = handler
+        self.ids = 0
+        self.pending: dict[int, asyncio.Future] = {}
+        self.tasks = set()
+        self.closed = asyncio.Event()
+
+    async def send(self, payload: dict):
+        self.writer.write(json.dumps(payload).encode() + b"\n")
+        await self.writer.drain()
+
+    async def call(self, method: str, **params):
+        if self.closed.is_set():
+            raise RemoteError("Connection closed")
+        self.ids += 1
+        call_id = self.ids
+        future = self.pending[call_id] = asyncio.get_running_loop().create_future()
+        try:
+            await self.send({"id": call_id, "method": method, "params": params})
+            return await future
+        finally:
+            self.pending.pop(call_id, None)
+
+    async def serve(self):
+        try:
+            while line := await self.reader.readline():
+                payload = json.loads(line)
+                if "method" in payload:
+                    task = asyncio.create_task(self.dispatch(payload))
+                    self.tasks.add(task)
+                    task.add_done_callback(self.tasks.discard)
+                    continue
+                future = self.pending.get(payload["id"])
+                if future is None or future.done():
+                    continue
+                if payload.get("error") is not None:
+                    future.set_exception(RemoteError(payload["error"]))
+                else:
+                    future.set_result(payload.get("result"))
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            logger.warning(f"Connection lost: {e}")
+        finally:
+            self.closed.set()
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(RemoteError("Connection closed"))
+            for task in list(self.tasks):
+                task.cancel()
+
+    async def dispatch(self, payload: dict):
+        try:
+            result = await getattr(self.handler, f"rpc_{payload['method']}")(**payload["params"])
+            response = {"id": payload["id"], "result": result}
+        except Exception as e:
+            logger.error(f"Error handling {payload['method']}: {e}")
+            response = {"id": payload["id"], "error": str(e) or type(e).__name__}
+        try:
+            await self.send(response)
+        except ConnectionError:
+            pass
+
+    async def close(self):
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except ConnectionError:
+            pass
+
+
+class RemoteMessage:
+    __slots__ = ("id", "chat", "text")
+
+    def __init__(self, message_id: int, chat_id: int, text: str):
+        self.id = message_id
+        self.chat = RemoteChat(chat_id)
+        self.text = text
+
+
+class RemoteChat:
+    __slots__ = ("id",)
+
+    def __init__(self, chat_id: int):
+        self.id = chat_id
+
+
+class RemoteBot:
+    # stands in for the bot client inside workers, messages are sent by the coordinator
+    def __init__(self):
+        self.connection: Connection = None
+
+    async def send_message(self, chat_id, text, **kwargs):
+        result = await self.connection.call("send_message", chat_id=chat_id, text=text)
+        return RemoteMessage(result["id"], result["chat_id"], text)
+
+    async def edit_message_text(self, chat_id, message_id, text, **kwargs):
+        result = await self.connection.call("edit_message", chat_id=chat_id, message_id=message_id, text=text)
+        return RemoteMessage(result["id"], result["chat_id"], text)
+
+    async def ask(self, chat_id, text, **kwargs):
+        raise RemoteError("Conversations are handled by the coordinator")
+
+
+def message_result(message) -> dict:
+    return {"id": message.id, "chat_id": message.chat.id}
+
+
+class Coordinator:
+    def __init__(self, manager, path: str, workers: int, command: list, restart_delay: float = 5.0):
+        self.manager = manager
+        self.path = path
+        self.workers = workers
+        self.command = command
+        self.restart_delay = restart_delay
+        self.ring = HashRing(range(workers))
+        self.connections: dict[int, Connection] = {}
+        self.processes = {}
+        self.supervisors = []
+        self.server = None
+        self.closing = False
+        self.changed = asyncio.Condition()
+
+    async def start(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.server = await asyncio.start_unix_server(self.on_connect, self.path, limit=STREAM_LIMIT)
+        self.supervisors = [asyncio.create_task(self.supervise(i)) for i in range(self.workers)]
+        logger.info(f"Coordinator listening on {self.path} for {self.workers} workers")
+
+    async def supervise(self, number: int):
+        while not self.closing:
+            process = await asyncio.create_subprocess_exec(*self.command, "--worker", str(number))
+            self.processes[number] = process
+            code = await process.wait()
+            if self.closing:
+                break
+            logger.error(f"Worker {number} exited with code {code}, restarting in {self.restart_delay}s")
+            await asyncio.sleep(self.restart_delay)
+
+    async def on_connect(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        hello = json.loads(await reader.readline())
+        number = hello["worker"]
+        connection = Connection(reader, writer, self)
+        async with self.changed:
+            self.connections[number] = connection
+            self.changed.notify_all()
+        logger.info(f"Worker {number} connected")
+        await connection.serve()
+        async with self.changed:
+            if self.connections.get(number) is connection:
+                self.connections.pop(number)
+        logger.warning(f"Worker {number} disconnected")
+
+    async def connection_for(self, user_id: int, timeout: float = 30.0) -> Connection:
+        # a restarting worker hands its users to the next one on the ring rather than stalling them
+        async with self.changed:
+            await asyncio.wait_for(self.changed.wait_for(lambda: self.connections), timeout)
+            return self.connections[self.ring.node_for(user_id, self.connections)]
+
+    async def call(self, user_id: int, method: str, **params):
+        connection = await self.connection_for(user_id)
+        record = self.manager.registry.get(user_id)
+        return await connection.call(method, user_id=user_id, record=record.to_list() if record else None, **params)
+
+    async def rpc_send_message(self, chat_id, text):
+        message = await self.manager.send_message(chat_id, text)
+        return message_result(await self.delivered(message.delivered))
+
+    async def rpc_edit_message(self, chat_id, message_id, text):
+        return message_result(await self.delivered(self.manager.outbox.edit(RemoteMessage(message_id, chat_id, None),
+                                                                            text)))
+
+    @staticmethod
+    async def delivered(future):
+        # workers wait for the real message id, so failures are reported back to them
+        message = await future
+        if message is None:
+            raise RemoteError("Message could not be delivered")
+        return message
+
+    async def close(self):
+        self.closing = True
+        if self.server is not None:
+            self.server.close()
+        for process in self.processes.values():
+            if process.returncode is None:
+                process.send_signal(signal.SIGTERM)
+        await asyncio.gather(*[i.wait() for i in self.processes.values()], return_exceptions=True)
+        for task in self.supervisors:
+            task.cancel()
+        await asyncio.gather(*self.supervisors, return_exceptions=True)
+        for connection in list(self.connections.values()):
+            await connection.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class Worker:
+    def __init__(self, manager, path: str, number: int, workers: int):
+        self.manager = manager
+        self.path = path
+        self.number = number
+        self.ring = HashRing(range(workers))
+
+    def owns(self, user_id: int) -> bool:
+        return self.ring.node_for(user_id) == self.number
+
+    def update(self, user_id: int, record):
+        if record is not None:
+            self.manager.registry.add(UserRecord.from_list(record))
+
+    async def run(self):
+        reader, writer = await asyncio.open_unix_connection(self.path, limit=STREAM_LIMIT)
+        writer.write(json.dumps({"worker": self.number}).encode() + b"\n")
+        await writer.drain()
+        connection = self.manager.app.connection = Connection(reader, writer, self)
+        await self.manager.start_worker(self.owns)
+        logger.info(f"Worker {self.number} ready")
+        await connection.serve()
+
+    async def rpc_summarise(self, user_id: int, record, hours: int):
+        self.update(user_id, record)
+        await self.manager.summarise_user_chats(user_id, hours)
+
+    async def rpc_list(self, user_id: int, record, query: str, page: int):
+        self.update(user_id, record)
+        await self.manager.list(user_id, query, page)
+
+    async def rpc_list_current(self, user_id: int, record):
+        self.update(user_id, record)
+        await self.manager.list_all_current_chats(user_id)
+
+    async def rpc_update_user(self, user_id: int, record):
+        previous = self.manager.registry.get(user_id)
+        self.update(user_id, record)
+        if self.manager.live is not None:
+            for chat_id in (previous.chats if previous else set()) - self.manager.registry.get(user_id).chats:
+                self.manager.live.untrack(user_id, chat_id)
+            self.manager.listen(user_id)
+
+    async def rpc_forget(self, user_id: int, record):
+        await self.manager.close_user(user_id)
+        self.manager.registry.remove(user_id)
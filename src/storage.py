@@ -0,0 +1,137 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+from abc import ABC, abstractmethod
+
+logger = logging.getLogger(__name__)
+
+
+class Storage(ABC):
+    @abstractmethod
+    async def load(self) -> dict:
+        ...
+
+    @abstractmethod
+    async def save_user(self, user_id: str, record):
+        ...
+
+    @abstractmethod
+    async def delete_user(self, user_id: str):
+        ...
+
+    def close(self):
+        pass
+
+
+def read_json(filename: str) -> dict:
+    try:
+        with open(filename, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        logger.warning("No previous configs found")
+        return {}
+
+
+def write_json_atomic(filename: str, data: str):
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=".tmp-", suffix=".json")
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, filename)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+class JsonStorage(Storage):
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.data = {}
+        self.lock = asyncio.Lock()
+
+    async def load(self) -> dict:
+        self.data = await asyncio.to_thread(read_json, self.filename)
+        return {k: json.loads(json.dumps(v)) for k, v in self.data.items()}
+
+    async def flush(self):
+        # serialise on the loop so the snapshot can't change under the writer thread
+        snapshot = json.dumps(self.data, indent=2)
+        async with self.lock:
+            await asyncio.to_thread(write_json_atomic, self.filename, snapshot)
+
+    async def save_user(self, user_id: str, record):
+        self.data[user_id] = json.loads(json.dumps(record))
+        await self.flush()
+
+    async def delete_user(self, user_id: str):
+        self.data.pop(user_id, None)
+        await self.flush()
+
+
+class SQLiteStorage(Storage):
+    def __init__(self, filename: str, json_file: str = None):
+        self.filename = filename
+        self.json_file = json_file
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS users (user_id TEXT PRIMARY KEY, record TEXT NOT NULL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.db.commit()
+
+    def _load(self) -> dict:
+        with self.lock:
+            rows = self.db.execute("SELECT user_id, record FROM users").fetchall()
+            imported = self.db.execute("SELECT value FROM meta WHERE key = 'json_imported'").fetchone()
+        if imported is None and self.json_file and os.path.exists(self.json_file):
+            return self._import_json(rows)
+        return {k: json.loads(v) for k, v in rows}
+
+    def _import_json(self, rows: list) -> dict:
+        # only done once, an empty table afterwards means every user was removed
+        data = read_json(self.json_file) if not rows else {}
+        with self.lock, self.db:
+            self.db.executemany("INSERT OR REPLACE INTO users VALUES (?, ?)",
+                                [(k, json.dumps(v)) for k, v in data.items()])
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('json_imported', ?)", (self.json_file,))
+        if data:
+            logger.info(f"Imported {len(data)} users from {self.json_file}")
+            return data
+        return {k: json.loads(v) for k, v in rows}
+
+    def _save_user(self, user_id: str, record: str):
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO users VALUES (?, ?)", (user_id, record))
+
+    def _delete_user(self, user_id: str):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
+
+    async def load(self) -> dict:
+        return await asyncio.to_thread(self._load)
+
+    async def save_user(self, user_id: str, record):
+        await asyncio.to_thread(self._save_user, user_id, json.dumps(record))
+
+    async def delete_user(self, user_id: str):
+        await asyncio.to_thread(self._delete_user, user_id)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def create_storage(kind: str, json_file: str) -> Storage:
+    if kind == "json":
+        return JsonStorage(json_file)
+    if kind == "sqlite":
+        return SQLiteStorage(f"{os.path.splitext(json_file)[0]}.db", json_file=json_file)
+    raise ValueError(f"Unknown storage backend: {kind}")
@@ -0,0 +1,109 @@
+import asyncio
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from src.metrics import CACHE_REQUESTS
+
+logger = logging.getLogger(__name__)
+
+
+def normalise(text: str) -> str:
+    return "\n".join(line.strip() for line in text.strip().splitlines() if line.strip())
+
+
+def make_key(model: str, phrase: str, text: str) -> str:
+    return hashlib.sha256(f"{model}\0{phrase}\0{normalise(text)}".encode()).hexdigest()
+
+
+class SummaryCache:
+    def __init__(self, max_entries: int = 1024, ttl: float = 86400.0, filename: str = None, name: str = "summary"):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+        self.db = None
+        self.lock = threading.Lock()
+        if filename:
+            self.db = sqlite3.connect(filename, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS summaries (key TEXT PRIMARY KEY, value TEXT, expires REAL)")
+            self.db.execute("DELETE FROM summaries WHERE expires < ?", (time.time(),))
+            self.db.commit()
+
+    def _disk_get(self, key: str):
+        with self.lock:
+            row = self.db.execute("SELECT value FROM summaries WHERE key = ? AND expires >= ?",
+                                  (key, time.time())).fetchone()
+        return row[0] if row else None
+
+    def _disk_set(self, key: str, value: str):
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO summaries VALUES (?, ?, ?)", (key, value, time.time() + self.ttl))
+
+    def remember(self, key: str, value: str):
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    async def get(self, key: str):
+        entry = self.entries.get(key)
+        if entry is not None:
+            if entry[0] >= time.monotonic():
+                self.entries.move_to_end(key)
+                return entry[1]
+            self.entries.pop(key)
+        if self.db is not None:
+            value = await asyncio.to_thread(self._disk_get, key)
+            if value is not None:
+                self.remember(key, value)
+                return value
+        return None
+
+    async def set(self, key: str, value: str):
+        self.remember(key, value)
+        if self.db is not None:
+            await asyncio.to_thread(self._disk_set, key, value)
+
+    async def get_or_compute(self, key: str, compute):
+        value = await self.get(key)
+        if value is not None:
+            self.hits += 1
+            CACHE_REQUESTS.inc(cache=self.name, result="hit")
+            return value
+        # identical requests already in flight (e.g. two users tracking one group) share one call
+        if key in self.pending:
+            self.hits += 1
+            CACHE_REQUESTS.inc(cache=self.name, result="coalesced")
+            return await asyncio.shield(self.pending[key])
+        self.misses += 1
+        CACHE_REQUESTS.inc(cache=self.name, result="miss")
+        future = asyncio.get_running_loop().create_future()
+        self.pending[key] = future
+        try:
+            value = await compute()
+            await self.set(key, value)
+            future.set_result(value)
+            return value
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # nobody may be waiting on it, don't let asyncio complain about an unretrieved exception
+            future.exception()
+            raise
+        finally:
+            self.pending.pop(key, None)
+
+    def close(self):
+        if self.db is not None:
+            with self.lock:
+                self.db.close()
@@ -0,0 +1,111 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+from src.metrics import QUEUE_WAIT, current_trace
+
+logger = logging.getLogger(__name__)
+
+
+class Job:
+    def __init__(self, user_id: int, run, name: str = ""):
+        self.user_id = user_id
+        self.run = run
+        self.name = name
+        self.future = asyncio.get_running_loop().create_future()
+        self.enqueued = time.monotonic()
+        self.trace = current_trace.get()
+
+
+class FairQueue:
+    def __init__(self, workers: int = 5, weights: dict = None, default_weight: float = 1.0):
+        self.workers = workers
+        self.weights = weights or {}
+        self.default_weight = default_weight
+        self.queues: dict[int, deque] = {}
+        self.active = deque()
+        self.deficits: dict[int, float] = {}
+        self.condition = asyncio.Condition()
+        self.tasks = []
+        self.running = 0
+
+    def weight(self, user_id: int) -> float:
+        return self.weights.get(user_id, self.weights.get(str(user_id), self.default_weight))
+
+    def start(self):
+        if not self.tasks:
+            self.tasks = [asyncio.create_task(self.worker(i)) for i in range(self.workers)]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    def depth(self) -> int:
+        return sum(len(i) for i in self.queues.values())
+
+    def position(self, user_id: int, index: int) -> int:
+        # with round robin, each other user gets served about weight-proportional jobs per own job
+        own_weight = self.weight(user_id)
+        ahead = index
+        for other, queue in self.queues.items():
+            if other != user_id:
+                ahead += min(len(queue), int((index + 1) * self.weight(other) / own_weight))
+        return ahead + 1
+
+    async def submit(self, user_id: int, run, name: str = "") -> tuple:
+        job = Job(user_id, run, name)
+        async with self.condition:
+            queue = self.queues.get(user_id)
+            if queue is None:
+                queue = self.queues[user_id] = deque()
+                self.deficits[user_id] = 0.0
+                self.active.append(user_id)
+            queue.append(job)
+            position = self.position(user_id, len(queue) - 1)
+            self.condition.notify()
+        return job.future, position
+
+    def next_job(self) -> Job:
+        # deficit round robin: each turn a user earns its weight and spends 1 per job
+        while True:
+            user_id = self.active[0]
+            queue = self.queues[user_id]
+            if self.deficits[user_id] < 1:
+                self.deficits[user_id] += self.weight(user_id)
+                self.active.rotate(-1)
+                continue
+            self.deficits[user_id] -= 1
+            job = queue.popleft()
+            if not queue:
+                self.active.popleft()
+                self.queues.pop(user_id)
+                self.deficits.pop(user_id)
+            return job
+
+    async def worker(self, number: int):
+        while True:
+            async with self.condition:
+                while not self.active:
+                    await self.condition.wait()
+                job = self.next_job()
+            if job.future.cancelled():
+                continue
+            QUEUE_WAIT.observe(time.monotonic() - job.enqueued)
+            current_trace.set(job.trace)
+            self.running += 1
+            try:
+                result = await job.run()
+                if not job.future.done():
+                    job.future.set_result(result)
+            except asyncio.CancelledError:
+                job.future.cancel()
+                raise
+            except Exception as e:
+                logger.error(f"Job {job.name} for user {job.user_id} failed: {e}")
+                if not job.future.done():
+                    job.future.set_exception(e)
+            finally:
+                self.running -= 1
@@ -0,0 +1,31 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.bot_manager import DigestEntry, build_digest_prompt, split_digest
+
+TITLES = ["Team", "Family"]
+
+
+def test_prompt_headers_are_bare_numbers():
+    prompt = build_digest_prompt([DigestEntry(1, "Team", "a: hi"), DigestEntry(2, "Family", "b: hey")])
+    assert prompt.splitlines()[0] == "### 1"
+    assert "### 2\nChat: Family\nb: hey" in prompt
+
+
+def test_split_bare_headers():
+    assert split_digest("### 1\nstandup moved\n### 2\ndinner at 8", TITLES) == {1: "standup moved", 2: "dinner at 8"}
+
+
+def test_split_headers_repeating_the_title():
+    text = "### 1 Team\nstandup moved\n### 2 - family\ndinner at 8"
+    assert split_digest(text, TITLES) == {1: "standup moved", 2: "dinner at 8"}
+
+
+def test_split_keeps_unrelated_headings_in_the_text():
+    text = "### 1\nplanning\n## 2026 roadmap\n### 2026\n### 2 things to note\nship it\n### 2\ndinner at 8"
+    assert split_digest(text, TITLES) == {
+        1: "planning\n## 2026 roadmap\n### 2026\n### 2 things to note\nship it",
+        2: "dinner at 8",
+    }
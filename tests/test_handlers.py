@@ -0,0 +1,53 @@
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench.fakes import Obj
+from src.handlers import register_handlers
+
+USER = 42
+
+
+class CommandApp:
+    def __init__(self):
+        self.callbacks = []
+
+    def on_message(self, filters):
+        def decorator(callback):
+            self.callbacks.append(callback)
+            return callback
+        return decorator
+
+    def callback(self, name: str):
+        return next(i for i in self.callbacks if i.__name__ == f"{name}_command")
+
+
+class StartingManager:
+    def __init__(self):
+        self.started = asyncio.Event()
+        self.listed = []
+
+    async def list_all_current_chats(self, user_id: int):
+        # BotManager.start fills the registry right before setting started
+        assert self.started.is_set(), "handler ran before the registry was loaded"
+        self.listed.append(user_id)
+
+    async def send_message(self, chat_id, text, status: bool = False):
+        raise AssertionError(text)
+
+
+def test_commands_wait_for_registry():
+    async def scenario():
+        app, manager = CommandApp(), StartingManager()
+        register_handlers(app, manager, {USER})
+        message = Obj(chat=Obj(id=USER), from_user=Obj(id=USER), command=["list_current"])
+        task = asyncio.create_task(app.callback("list_current")(None, message))
+        await asyncio.sleep(0.01)
+        assert not task.done() and manager.listed == []
+        manager.started.set()
+        await asyncio.wait_for(task, timeout=1)
+        assert manager.listed == [USER]
+
+    asyncio.run(scenario())
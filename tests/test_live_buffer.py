@@ -0,0 +1,39 @@
+import asyncio
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench.fakes import FakeUserClient
+from src.live_buffer import LiveBuffer, LiveIngest
+from src.rate_limit import TokenBucket
+from src.session_pool import SessionPool
+
+CHAT = -1001234567890
+
+
+def test_restarted_listener_catches_up_and_listens_again():
+    client = FakeUserClient(messages_per_hour=5, page_latency=0, connect_latency=0)
+    pool = SessionPool(0, "", max_sessions=2)
+    pool.create_client = lambda phone: client
+    ingest = LiveIngest(LiveBuffer(), pool, TokenBucket("Telegram", 1000))
+    since = datetime.now(timezone.utc) - timedelta(hours=2)
+
+    async def run():
+        await ingest.subscribe(1, "+1", [CHAT])
+        before = len(ingest.buffer.lines(1, CHAT, since))
+        # the connection drops, the next acquire restarts the client and pyrogram forgets the handler
+        client.is_connected = False
+        async with pool.session(1, "+1"):
+            assert ingest.buffer.lines(1, CHAT, since) is None
+            # posted while nobody was listening
+            await client.push(CHAT)
+        await asyncio.gather(*ingest.tasks)
+        assert len(ingest.buffer.lines(1, CHAT, since)) == before + 1
+        await client.push(CHAT)
+        assert len(ingest.buffer.lines(1, CHAT, since)) == before + 2
+        await ingest.close()
+        await pool.close()
+
+    asyncio.run(run())
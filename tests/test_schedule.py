@@ -0,0 +1,29 @@
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench.fakes import FakeBotApp
+from src.registry import UserRecord
+from test_shared_access import make_manager
+
+
+def test_skipped_digest_is_rescheduled(tmp_path):
+    manager = make_manager(tmp_path, FakeBotApp(latency=0))
+    manager.registry.add(UserRecord(1, 2, phone="+1", chats=[1]))
+
+    async def run():
+        previous = asyncio.create_task(asyncio.sleep(3600))
+        manager.running_tasks[1] = previous
+        before = time.time()
+        manager.start_digest(1)
+        assert manager.running_tasks[1] is previous
+        previous.cancel()
+        return before
+
+    before = asyncio.run(run())
+    record = manager.registry.get(1)
+    assert before + 2 * 3600 <= record.next_run <= time.time() + 2 * 3600 + manager.schedule_jitter
+    assert manager.scheduler.next_runs[1] == record.next_run
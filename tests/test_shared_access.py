@@ -0,0 +1,99 @@
+import asyncio
+import logging
+import os
+import sys
+import time
+
+from pyrogram.errors import ChannelPrivate
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench.fakes import FakeBotApp, FakeLLM, FakeUserClient, Obj
+from src.bot_manager import BotManager
+from src.registry import UserRecord
+
+SUPERGROUP = -1001234567890
+
+
+class RecordingBotApp(FakeBotApp):
+    def __init__(self):
+        super().__init__(latency=0)
+        self.texts = {}
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.texts.setdefault(chat_id, []).append(text)
+        return await super().send_message(chat_id, text, **kwargs)
+
+    async def edit_message_text(self, chat_id, message_id, text, **kwargs):
+        self.texts.setdefault(chat_id, []).append(text)
+        return await super().edit_message_text(chat_id, message_id, text, **kwargs)
+
+
+class KickedClient(FakeUserClient):
+    async def get_chat(self, chat_id):
+        self.maybe_flood()
+        raise ChannelPrivate()
+
+    async def get_chat_history(self, chat_id, limit: int = 0, offset_id: int = 0):
+        self.maybe_flood()
+        raise ChannelPrivate()
+        yield
+
+
+def make_manager(tmp_path, app):
+    manager = BotManager(app=app, api_id=0, api_hash="", openai_api="test", phrase="Summarise", model="gpt-4o-mini",
+                         json_file=str(tmp_path / "users.json"), storage="json", telegram_rate=1000, bot_rate=1000,
+                         bot_chat_rate=1000, message_cache_file=str(tmp_path / "messages.db"), digest=False,
+                         warm_sessions=0, stream=False)
+    manager.llm = FakeLLM(latency=0, tokens_per_second=10 ** 6)
+    return manager
+
+
+def test_expired_access_is_checked_before_serving_shared_history(tmp_path):
+    logging.disable(logging.WARNING)
+    app = RecordingBotApp()
+    manager = make_manager(tmp_path, app)
+    clients = {"+1": FakeUserClient(page_latency=0, connect_latency=0), "+2": KickedClient(page_latency=0,
+                                                                                            connect_latency=0)}
+    manager.session_pool.create_client = clients.__getitem__
+
+    async def run():
+        await manager.start()
+        for user_id in (1, 2):
+            manager.registry.add(UserRecord(user_id, 0, phone=f"+{user_id}", chats=[SUPERGROUP]))
+        async with manager.open_session(1) as client:
+            await manager.resolve_chats(client, 1, [SUPERGROUP])
+        await manager.summarise_user_chats(1, 6)
+        # user 2 was shown the chat once, but longer ago than the index ttl, and has left it since
+        manager.chat_index.put(2, Obj(id=SUPERGROUP, title="Group", type=None))
+        manager.chat_index.user(2).chats[SUPERGROUP].checked_at = time.monotonic() - manager.chat_index.ttl - 1
+        await manager.summarise_user_chats(2, 6)
+        await manager.shutdown()
+
+    asyncio.run(run())
+    assert any(i.startswith("Summary for the past") for i in app.texts[1])
+    assert not any(i.startswith("Summary for the past") for i in app.texts[2])
+    assert clients["+2"].api_calls > 0
+
+
+def test_confirmed_access_is_served_without_a_session(tmp_path):
+    logging.disable(logging.WARNING)
+    app = RecordingBotApp()
+    manager = make_manager(tmp_path, app)
+    clients = {"+1": FakeUserClient(page_latency=0, connect_latency=0)}
+    manager.session_pool.create_client = clients.__getitem__
+
+    async def run():
+        await manager.start()
+        for user_id in (1, 2):
+            manager.registry.add(UserRecord(user_id, 0, phone=f"+{user_id}", chats=[SUPERGROUP]))
+        async with manager.open_session(1) as client:
+            await manager.resolve_chats(client, 1, [SUPERGROUP])
+        await manager.summarise_user_chats(1, 6)
+        manager.chat_index.put(2, Obj(id=SUPERGROUP, title="Group", type=None))
+        await manager.summarise_user_chats(2, 6)
+        await manager.shutdown()
+
+    asyncio.run(run())
+    assert any(i.startswith("Summary for the past") for i in app.texts[2])
+    assert "+2" not in manager.session_pool.sessions